@@ -5,21 +5,48 @@ Code adapted and expanded from the original Udacity code project.
 import numpy as np
 import random
 import copy
+import contextlib
+import os
+import threading
+from time import time
 
-from model import Actor, Critic
-from replay_buffer import ReplayBuffer
-from ounoise import OUNoise
+from model import Actor, Critic, StackedActor, StackedCritic, has_mode_dependent_layers, flatten_parameters
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer, AgentReplayView, BatchPrefetcher, NStepAccumulator, create_storage_dir
+from ounoise import make_noise
 
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 import torch.optim as optim
 
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+def max_action_deviation(reference, candidate, states):
+    """Return the largest absolute difference between the actions of two actors for the given states."""
+    with torch.no_grad():
+        return (reference(states) - candidate(states)).abs().max().item()
+
+def save_module(module, path):
+    """Save a TorchScript module next to path and rename it over path, so readers never load a partial file."""
+    temporary_path = path + '.tmp'
+    torch.jit.save(module, temporary_path)
+    os.replace(temporary_path, path)
+
+def check_bf16_autocast(enabled):
+    """Fail early if bfloat16 autocast is requested from a torch without torch.autocast (added in 1.10)."""
+    if enabled and not hasattr(torch, "autocast"):
+        raise RuntimeError("BF16_AUTOCAST needs torch 1.10 or newer, found torch {}".format(torch.__version__))
+
+def bf16_autocast(enabled):
+    """Return the context in which the local networks run: bfloat16 autocast if enabled, else nothing."""
+    if not enabled:
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=torch.bfloat16)
+
 class DDPGAgent():
     """Interacts with and learns from the environment."""
     
-    def __init__(self, state_size, action_size, hyperparameters, num_agents, random_seed):
+    def __init__(self, state_size, action_size, hyperparameters, num_agents, random_seed, memory=None, agent_index=0):
         """Initialize an Agent object.
         
         Params
@@ -27,6 +54,9 @@ class DDPGAgent():
             state_size (int): dimension of each state
             action_size (int): dimension of each action
             random_seed (int): random seed
+            memory: replay memory shared with other agents (None creates a private buffer).
+                A shared memory is filled by its owner, so step() only learns from it.
+            agent_index (int): index of the first agent controlled, which selects the agents' noise streams
         """
         self.state_size = state_size
         self.action_size = action_size
@@ -37,77 +67,278 @@ class DDPGAgent():
         self.actor_local = Actor(state_size, action_size, random_seed).to(device)
         self.actor_target = Actor(state_size, action_size, random_seed).to(device)
         self.actor_optimizer = optim.Adam(self.actor_local.parameters(), lr=hyperparameters.LR_ACTOR)
+        # Switching to eval() mode for acting is only needed if the actor has train/eval-sensitive layers:
+        self.actor_mode_dependent = has_mode_dependent_layers(self.actor_local)
+        # Reusable output buffer for act():
+        self.actions = np.zeros((num_agents, action_size))
+        # Device of the actor used by act(); quantized inference actors run on the CPU:
+        self.acting_device = device
 
         # Critic Network (w/ Target Network)
         self.critic_local = Critic(state_size, action_size, random_seed).to(device)
         self.critic_target = Critic(state_size, action_size, random_seed).to(device)
         self.critic_optimizer = optim.Adam(self.critic_local.parameters(), lr=hyperparameters.LR_CRITIC, weight_decay=hyperparameters.WEIGHT_DECAY)
 
-        # Noise process for each agent
-        self.noise = OUNoise((num_agents, action_size), hyperparameters, random_seed)
+        # Noise process for each agent, with the random streams of the agents it controls
+        self.noise = make_noise((num_agents, action_size), hyperparameters, random_seed,
+                                streams=range(agent_index, agent_index + num_agents))
 
-        # Replay memory
-        self.memory = ReplayBuffer(action_size, hyperparameters.BUFFER_SIZE, hyperparameters.BATCH_SIZE, random_seed)
-        
         self.batch_size = hyperparameters.BATCH_SIZE
         self.gamma = hyperparameters.GAMMA
         self.tau = hyperparameters.TAU
+        self.hard_update_every = hyperparameters.HARD_UPDATE_EVERY
+        self.bf16_autocast = hyperparameters.BF16_AUTOCAST
+        check_bf16_autocast(self.bf16_autocast)
+        self.learn_step = 0
+        # Keep the parameters of each network in one flat tensor for fused target updates:
+        for network in (self.actor_local, self.actor_target, self.critic_local, self.critic_target):
+            flatten_parameters(network)
+
+        # Learning schedule: K updates every N steps once the memory holds more than the warm-up size
+        self.warmup_size = max(hyperparameters.WARMUP_SIZE, self.batch_size)
+        self.update_every = hyperparameters.UPDATE_EVERY
+        self.updates_per_trigger = hyperparameters.UPDATES_PER_TRIGGER
+        self.t_step = 0
+
+        # Replay memory, either shared with other agents or private to this agent
+        self.shared_memory = memory is not None
+        self.memory = memory if self.shared_memory else self.create_memory(hyperparameters, random_seed)
+        # Private memories store n-step transitions if enabled; a shared memory is filled by its owner:
+        self.n_step_accumulator = None
+        if hyperparameters.N_STEP > 1 and not self.shared_memory:
+            self.n_step_accumulator = NStepAccumulator(hyperparameters.N_STEP, self.gamma)
+        # Optionally sample batches ahead of time on a worker thread. The asynchronous learner
+        # always samples through the prefetcher, which serialises writes and sampling:
+        if hyperparameters.PREFETCH_BATCHES > 0 or hyperparameters.ASYNC_LEARNER:
+            # Each agent's worker samples on its own schedule, so the rounds of a shared buffer's
+            # same-rows sampling would pair up batches according to thread timing:
+            if isinstance(memory, AgentReplayView) and memory.buffer.same_indices:
+                raise ValueError("SHARED_SAMPLING cannot be used with PREFETCH_BATCHES or ASYNC_LEARNER")
+            self.memory = BatchPrefetcher(self.memory, queue_size=max(hyperparameters.PREFETCH_BATCHES, 1), min_size=self.warmup_size)
+
+        # Held for the duration of every learning update, e.g. to snapshot consistent weights:
+        self.learn_lock = threading.Lock()
+        # Optionally learn on a background thread, and act with a periodically synced copy of the actor:
+        self.actor_acting = self.actor_local
+        self.async_learner = None
+        if hyperparameters.ASYNC_LEARNER:
+            self.actor_acting = copy.deepcopy(self.actor_local).requires_grad_(False)
+            flatten_parameters(self.actor_acting)
+            self.async_learner = AsyncLearner(self, sync_every=hyperparameters.ACTOR_SYNC_EVERY,
+                                              max_learn_ratio=hyperparameters.MAX_LEARN_RATIO)
     
+    def create_memory(self, hyperparameters, random_seed):
+        """Create a private replay buffer, optionally memory-mapped to files in the results folder."""
+        storage_dir = create_storage_dir(hyperparameters.ITERATION) if hyperparameters.REPLAY_MEMMAP else None
+        if hyperparameters.USE_PER:
+            return PrioritizedReplayBuffer(self.state_size, self.action_size, hyperparameters.BUFFER_SIZE, hyperparameters.BATCH_SIZE, random_seed,
+                                           storage_dir=storage_dir,
+                                           dtypes=hyperparameters.REPLAY_DTYPES,
+                                           store_discounts=hyperparameters.N_STEP > 1,
+                                           alpha=hyperparameters.PER_ALPHA,
+                                           beta=hyperparameters.PER_BETA,
+                                           beta_increment=hyperparameters.PER_BETA_INCREMENT,
+                                           epsilon=hyperparameters.PER_EPSILON)
+        if hyperparameters.DEDUPLICATE_STATES and hyperparameters.N_STEP > 1:
+            raise ValueError("DEDUPLICATE_STATES needs N_STEP = 1: an n-step row's state is not the previous row's next state, "
+                             "so every row would take two state slots and the buffer would hold far fewer experiences")
+        return ReplayBuffer(self.state_size, self.action_size, hyperparameters.BUFFER_SIZE, hyperparameters.BATCH_SIZE, random_seed,
+                            storage_dir=storage_dir,
+                            dtypes=hyperparameters.REPLAY_DTYPES,
+                            store_discounts=hyperparameters.N_STEP > 1,
+                            deduplicate_states=hyperparameters.DEDUPLICATE_STATES,
+                            stratified_fraction=hyperparameters.STRATIFIED_FRACTION)
+
     def step(self, states, actions, rewards, next_states, dones):
         """Save experience in replay memory, and use random sample from buffer to learn."""
-        # Save experience / reward
-        if self.num_agents > 1:
-            for agent in range(self.num_agents):
-                self.memory.add(states[agent,:], actions[agent,:], rewards[agent], next_states[agent,:], dones[agent])
-        else:
-            self.memory.add(states, actions, rewards, next_states, dones)
+        # Save experience / reward, one row per agent
+        if self.n_step_accumulator is not None:
+            transitions = self.n_step_accumulator.push(states, actions, rewards, next_states, dones)
+            if transitions is not None:
+                self.memory.add_batch(*transitions)
+        elif not self.shared_memory:
+            self.memory.add_batch(states, actions, rewards, next_states, dones)
         
-        # Learn, if enough samples are available in memory
-        if len(self.memory) > self.batch_size:
-            experiences = self.memory.sample()
-            self.learn(experiences)
+        # The asynchronous learner only needs to know that the environment moved on:
+        if self.async_learner is not None:
+            self.async_learner.notify_step()
+            return
+
+        # Learn every UPDATE_EVERY steps, if enough samples are available in memory
+        self.t_step += 1
+        if self.t_step % self.update_every == 0 and len(self.memory) > self.warmup_size:
+            if self.updates_per_trigger == 1:
+                self.learn(self.memory.sample())
+            else:
+                for experiences in self.memory.sample_batches(self.updates_per_trigger):
+                    self.learn(experiences)
 
     def act(self, state, add_noise=True):
-        """Returns actions for given state as per current policy."""
-        state = torch.from_numpy(state).float().to(device)
-        acts = np.zeros((self.num_agents, self.action_size))
-        self.actor_local.eval()
+        """Returns actions for given state as per current policy.
+
+        All agents' states go through the actor in a single batched forward pass. The
+        returned array is reused by the next call, so copy it if it needs to be kept.
+        """
+        state = torch.from_numpy(np.asarray(state, dtype=np.float32)).to(self.acting_device).view(self.num_agents, -1)
+        if self.actor_mode_dependent:
+            self.actor_acting.eval()
         with torch.no_grad():
-            if self.num_agents > 1:
-                for agent in range(self.num_agents):
-                    acts[agent,:] = self.actor_local(state[agent,:]).cpu().data.numpy()
+            if self.async_learner is None:
+                self.actions[:] = self.actor_acting(state).cpu().numpy()
             else:
-                acts[0,:] = self.actor_local(state).cpu().data.numpy()
-        self.actor_local.train()
+                with self.async_learner.sync_lock:
+                    self.actions[:] = self.actor_acting(state).cpu().numpy()
+        if self.actor_mode_dependent and self.async_learner is None:
+            self.actor_acting.train()
         if add_noise:
-            acts += self.noise.sample()
-        return np.clip(acts, -1, 1)
+            self.actions += self.noise.sample()
+        return np.clip(self.actions, -1, 1, out=self.actions)
+
+    def compile_for_inference(self, freeze=True, path=None):
+        """Trace the actor with TorchScript and act with the traced module from now on.
+
+        The traced module skips the Python-level module call overhead of act(). A frozen
+        module has its current weights folded in as constants, so only freeze an agent
+        which no longer learns. Returns the traced module.
+
+        Params
+        ======
+            freeze (bool): fold the weights into the traced graph
+            path (str): if given, save the traced module there; it loads with torch.jit.load()
+                without the model.py class definitions
+        """
+        if self.async_learner is not None:
+            raise ValueError("compile_for_inference() cannot be used with the asynchronous learner")
+        self.actor_local.eval()
+        example = torch.zeros(self.num_agents, self.state_size, device=device)
+        with torch.no_grad():
+            compiled = torch.jit.trace(self.actor_local, example)
+        if freeze:
+            compiled = torch.jit.freeze(compiled)
+        self.actor_local.train()
+        if path is not None:
+            save_module(compiled, path)
+        # The module was traced in eval mode, so act() no longer needs to switch modes:
+        self.actor_acting = compiled
+        self.actor_mode_dependent = False
+        return compiled
+
+    def quantize_for_inference(self, path=None):
+        """Quantize the actor's Linear layers to int8 and act with the quantized actor from now on.
+
+        Dynamic quantization stores the weights as int8 and quantizes the activations on the
+        fly, which makes the CPU forward pass cheaper; the actor is traced with TorchScript as in
+        compile_for_inference(). Returns the quantized module and its maximum action deviation
+        from the fp32 actor over a batch of random states.
+
+        Params
+        ======
+            path (str): if given, save the quantized module there; load it with load_inference_actor()
+        """
+        if self.async_learner is not None:
+            raise ValueError("quantize_for_inference() cannot be used with the asynchronous learner")
+        actor = copy.deepcopy(self.actor_local).cpu().eval()
+        quantized = torch.quantization.quantize_dynamic(actor, {nn.Linear}, dtype=torch.qint8)
+        with torch.no_grad():
+            quantized = torch.jit.trace(quantized, torch.zeros(self.num_agents, self.state_size))
+        deviation = max_action_deviation(actor, quantized, torch.randn(1024, self.state_size))
+        if path is not None:
+            save_module(quantized, path)
+        self.actor_acting = quantized
+        self.actor_mode_dependent = False
+        self.acting_device = torch.device("cpu")
+        return quantized, deviation
+
+    def load_inference_actor(self, path):
+        """Act on the CPU with an actor saved by compile_for_inference() or quantize_for_inference()."""
+        self.actor_acting = torch.jit.load(path, map_location="cpu")
+        self.actor_mode_dependent = False
+        self.acting_device = torch.device("cpu")
 
     def reset(self):
         self.noise.reset()
+        if self.n_step_accumulator is not None:
+            self.n_step_accumulator.reset()
+
+    def replay_buffer(self):
+        """Return the agent's private replay buffer (None if the memory is shared)."""
+        if self.shared_memory:
+            return None
+        return self.memory.memory if isinstance(self.memory, BatchPrefetcher) else self.memory
+
+    def state_dict(self):
+        """Return a copy of the agent's training state: networks, optimizers, noise and counters.
+        The replay memory is saved separately (see replay_buffer())."""
+        with self.learn_lock:
+            return copy.deepcopy({
+                'actor_local': self.actor_local.state_dict(),
+                'actor_target': self.actor_target.state_dict(),
+                'critic_local': self.critic_local.state_dict(),
+                'critic_target': self.critic_target.state_dict(),
+                'actor_optimizer': self.actor_optimizer.state_dict(),
+                'critic_optimizer': self.critic_optimizer.state_dict(),
+                'noise': self.noise.state_dict(),
+                't_step': self.t_step,
+                'learn_step': self.learn_step,
+                'n_step_window': self.n_step_accumulator.state_dict() if self.n_step_accumulator is not None else None,
+            })
+
+    def load_state_dict(self, state):
+        """Restore a training state returned by state_dict()."""
+        with self.learn_lock:
+            for name in ('actor_local', 'actor_target', 'critic_local', 'critic_target', 'actor_optimizer', 'critic_optimizer'):
+                getattr(self, name).load_state_dict(state[name])
+            self.noise.load_state_dict(state['noise'])
+            self.t_step, self.learn_step = state['t_step'], state['learn_step']
+            if self.n_step_accumulator is not None:
+                self.n_step_accumulator.load_state_dict(state['n_step_window'])
+            if self.async_learner is not None:
+                self.async_learner.sync()
+
+    def close(self):
+        """Release resources held by the agent, such as the learner thread and memory-mapped replay files."""
+        if self.async_learner is not None:
+            self.async_learner.close()
+        self.memory.close()
 
     def learn(self, experiences):
         """Update policy and value parameters using given batch of experience tuples.
         Q_targets = r + γ * critic_target(next_state, actor_target(next_state))
+        where γ is the stored discount of each experience (γ^n for n-step returns), or GAMMA
         where:
             actor_target(state) -> action
             critic_target(state, action) -> Q-value
         Params
         ======
-            experiences (Tuple[torch.Tensor]): tuple of (s, a, r, s', done) tuples 
-            gamma (float): discount factor
+            experiences (Experiences): tuple of (s, a, r, s', done) tensors, plus the discounts of
+                n-step experiences, and importance-sampling weights and buffer indices when sampled
+                from a prioritized buffer
         """
-        states, actions, rewards, next_states, dones = experiences
+        with self.learn_lock:
+            self.learn_batch(experiences)
+
+    def learn_batch(self, experiences):
+        """Run one learning update; see learn()."""
+        states, actions, rewards, next_states, dones = experiences[:5]
 
         # ---------------------------- update critic ---------------------------- #
         # Get predicted next-state actions and Q values from target models
         actions_next = self.actor_target(next_states)
         Q_targets_next = self.critic_target(next_states, actions_next)
         # Compute Q targets for current states (y_i)
-        Q_targets = rewards + (self.gamma * Q_targets_next * (1 - dones))
-        # Compute critic loss
-        Q_expected = self.critic_local(states, actions)
-        critic_loss = F.mse_loss(Q_expected, Q_targets)
+        gamma = self.gamma if experiences.discounts is None else experiences.discounts
+        Q_targets = rewards + (gamma * Q_targets_next * (1 - dones))
+        # Compute critic loss. The local networks may run in bfloat16, the targets above stay in fp32:
+        with self.autocast():
+            Q_expected = self.critic_local(states, actions)
+        Q_expected = Q_expected.float()
+        if experiences.weights is None:
+            critic_loss = F.mse_loss(Q_expected, Q_targets)
+        else:
+            # Prioritized replay: correct the sampling bias and refresh the sampled priorities
+            td_errors = Q_targets.detach() - Q_expected
+            critic_loss = (experiences.weights * td_errors.pow(2)).mean()
+            self.memory.update_priorities(experiences.indices, td_errors.detach().cpu().numpy())
         # Minimize the loss
         self.critic_optimizer.zero_grad()
         critic_loss.backward()
@@ -116,24 +347,281 @@ class DDPGAgent():
 
         # ---------------------------- update actor ---------------------------- #
         # Compute actor loss
-        actions_pred = self.actor_local(states)
-        actor_loss = -self.critic_local(states, actions_pred).mean()
+        with self.autocast():
+            actions_pred = self.actor_local(states)
+            actor_loss = -self.critic_local(states, actions_pred).float().mean()
         # Minimize the loss
         self.actor_optimizer.zero_grad()
         actor_loss.backward()
         self.actor_optimizer.step()
 
         # ----------------------- update target networks ----------------------- #
-        self.soft_update(self.critic_local, self.critic_target)
-        self.soft_update(self.actor_local, self.actor_target)                     
+        self.learn_step += 1
+        if not self.hard_update_every:
+            self.soft_update(self.critic_local, self.critic_target)
+            self.soft_update(self.actor_local, self.actor_target)
+        elif self.learn_step % self.hard_update_every == 0:
+            self.hard_update(self.critic_local, self.critic_target)
+            self.hard_update(self.actor_local, self.actor_target)
+
+    def autocast(self):
+        """Return the context in which the local networks run: bfloat16 autocast if enabled.
+        The parameters, gradients and Adam states stay in fp32."""
+        return bf16_autocast(self.bf16_autocast)
 
     def soft_update(self, local_model, target_model):
-        """Soft update model parameters.
+        """Soft update model parameters, in place over the flattened parameters.
         θ_target = τ*θ_local + (1 - τ)*θ_target
         Params
         ======
             local_model: PyTorch model (weights will be copied from)
             target_model: PyTorch model (weights will be copied to)
         """
-        for target_param, local_param in zip(target_model.parameters(), local_model.parameters()):
-            target_param.data.copy_(self.tau*local_param.data + (1.0-self.tau)*target_param.data)
\ No newline at end of file
+        target_model.flat_parameters.lerp_(local_model.flat_parameters, self.tau)
+
+    def hard_update(self, local_model, target_model):
+        """Copy the local model parameters into the target model.
+        Params
+        ======
+            local_model: PyTorch model (weights will be copied from)
+            target_model: PyTorch model (weights will be copied to)
+        """
+        target_model.flat_parameters.copy_(local_model.flat_parameters)
+
+
+class AsyncLearner():
+    """Runs a DDPGAgent's learning updates continuously on a background thread.
+
+    The learner samples from the agent's memory, which is wrapped in a BatchPrefetcher
+    so that adding experiences on the training loop and sampling are serialised. Torch
+    releases the GIL in its kernels, so learning overlaps with waiting on env.step().
+    Acting uses the agent's read-only copy of the actor, which is synced with
+    actor_local every sync_every updates. The learner never runs more than
+    max_learn_ratio updates per environment step.
+    """
+
+    def __init__(self, agent, sync_every=10, max_learn_ratio=1.0):
+        """Initialize an AsyncLearner object and start its thread.
+        Params
+        ======
+            agent (DDPGAgent): agent whose learn() runs on the thread
+            sync_every (int): number of updates between syncs of the acting actor
+            max_learn_ratio (float): maximum number of updates per environment step
+        """
+        self.agent = agent
+        self.sync_every = sync_every
+        self.max_learn_ratio = max_learn_ratio
+        self.env_steps = 0      # Environment steps reported by the agent
+        self.learn_steps = 0    # Learning updates run on the thread
+        self.syncs = 0          # Syncs of the acting actor
+        self.start_time = time()
+        self.error = None
+        self.sync_lock = threading.Lock()
+        self.condition = threading.Condition()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="AsyncLearner", daemon=True)
+        self.thread.start()
+
+    def notify_step(self):
+        """Count an environment step, allowing the learner to run further."""
+        if self.error is not None:
+            raise RuntimeError("the asynchronous learner failed") from self.error
+        with self.condition:
+            self.env_steps += 1
+            self.condition.notify()
+
+    def can_learn(self):
+        return (len(self.agent.memory) > self.agent.warmup_size
+                and self.learn_steps < self.max_learn_ratio * self.env_steps)
+
+    def run(self):
+        """Learn until closed, waiting whenever the learner is ahead of the step-ratio cap."""
+        try:
+            while not self.stop_event.is_set():
+                with self.condition:
+                    if not self.can_learn():
+                        self.condition.wait(0.01)
+                        continue
+                self.agent.learn(self.agent.memory.sample())
+                self.learn_steps += 1
+                if self.learn_steps % self.sync_every == 0:
+                    self.sync()
+        except Exception as error:
+            self.error = error
+
+    def sync(self):
+        """Copy actor_local into the actor used for acting."""
+        with self.sync_lock:
+            self.agent.actor_acting.flat_parameters.copy_(self.agent.actor_local.flat_parameters)
+        self.syncs += 1
+
+    def rates(self):
+        """Return the environment steps and learning updates per second since the learner started."""
+        elapsed = max(time() - self.start_time, 1e-9)
+        return self.env_steps / elapsed, self.learn_steps / elapsed
+
+    def close(self):
+        """Stop the learner thread after its current update."""
+        self.stop_event.set()
+        self.thread.join()
+
+
+class MultiAgentDDPG():
+    """Several DDPG agents which act and learn together in batched passes.
+
+    Each agent keeps its own actor, critic and target networks, but their weights are
+    stacked along a leading agent dimension (see model.StackedActor), so every forward
+    and backward pass covers all agents in one set of batched kernels. The agents stay
+    independent: their losses are summed, so each agent's slice of the gradients only
+    depends on its own loss, and Adam updates every element separately.
+    The agents learn from a shared MultiAgentReplayBuffer, which is filled by its owner.
+    """
+
+    def __init__(self, state_size, action_size, hyperparameters, num_agents, random_seed, memory):
+        """Initialize a MultiAgentDDPG object.
+
+        Params
+        ======
+            state_size (int): dimension of the joint state each agent observes
+            action_size (int): dimension of each agent's action
+            num_agents (int): number of agents
+            random_seed (int): random seed
+            memory (MultiAgentReplayBuffer): replay memory shared by the agents
+        """
+        self.state_size = state_size
+        self.action_size = action_size
+        self.num_agents = num_agents
+        self.seed = random.seed(random_seed)
+
+        # Actor Networks (w/ Target Networks)
+        self.actor_local = StackedActor(num_agents, state_size, action_size, random_seed).to(device)
+        self.actor_target = StackedActor(num_agents, state_size, action_size, random_seed).to(device)
+        self.actor_optimizer = optim.Adam(self.actor_local.parameters(), lr=hyperparameters.LR_ACTOR)
+        self.actor_mode_dependent = has_mode_dependent_layers(self.actor_local)
+        self.actions = np.zeros((num_agents, action_size))
+
+        # Critic Networks (w/ Target Networks)
+        self.critic_local = StackedCritic(num_agents, state_size, action_size, random_seed).to(device)
+        self.critic_target = StackedCritic(num_agents, state_size, action_size, random_seed).to(device)
+        self.critic_optimizer = optim.Adam(self.critic_local.parameters(), lr=hyperparameters.LR_CRITIC, weight_decay=hyperparameters.WEIGHT_DECAY)
+
+        # Noise process, one row and random stream per agent
+        self.noise = make_noise((num_agents, action_size), hyperparameters, random_seed)
+
+        self.batch_size = hyperparameters.BATCH_SIZE
+        self.gamma = hyperparameters.GAMMA
+        self.tau = hyperparameters.TAU
+        self.hard_update_every = hyperparameters.HARD_UPDATE_EVERY
+        self.bf16_autocast = hyperparameters.BF16_AUTOCAST
+        check_bf16_autocast(self.bf16_autocast)
+        self.learn_step = 0
+        for network in (self.actor_local, self.actor_target, self.critic_local, self.critic_target):
+            flatten_parameters(network)
+
+        self.warmup_size = max(hyperparameters.WARMUP_SIZE, self.batch_size)
+        self.update_every = hyperparameters.UPDATE_EVERY
+        self.updates_per_trigger = hyperparameters.UPDATES_PER_TRIGGER
+        self.t_step = 0
+        self.memory = memory
+        # The agents learn on the training loop; the lock only mirrors DDPGAgent for savers:
+        self.learn_lock = threading.Lock()
+
+    def step(self):
+        """Learn from the shared memory on the update schedule; the owner adds the experiences."""
+        self.t_step += 1
+        if self.t_step % self.update_every == 0 and len(self.memory) > self.warmup_size:
+            for experiences in self.memory.sample_agents(self.updates_per_trigger):
+                self.learn(experiences)
+
+    def act(self, state, add_noise=True):
+        """Returns every agent's actions, shaped (num_agents, action_size), for the joint state.
+
+        The returned array is reused by the next call, so copy it if it needs to be kept.
+        """
+        state = torch.from_numpy(np.asarray(state, dtype=np.float32)).to(device).view(1, 1, -1)
+        if self.actor_mode_dependent:
+            self.actor_local.eval()
+        with torch.no_grad():
+            self.actions[:] = self.actor_local(state.expand(self.num_agents, 1, -1))[:, 0].cpu().numpy()
+        if self.actor_mode_dependent:
+            self.actor_local.train()
+        if add_noise:
+            self.actions += self.noise.sample()
+        return np.clip(self.actions, -1, 1, out=self.actions)
+
+    def reset(self):
+        self.noise.reset()
+
+    def replay_buffer(self):
+        """The agents learn from a shared memory, which is saved by its owner."""
+        return None
+
+    def state_dict(self):
+        """Return a copy of the agents' training state: networks, optimizers, noise and counters."""
+        return copy.deepcopy({
+            'actor_local': self.actor_local.state_dict(),
+            'actor_target': self.actor_target.state_dict(),
+            'critic_local': self.critic_local.state_dict(),
+            'critic_target': self.critic_target.state_dict(),
+            'actor_optimizer': self.actor_optimizer.state_dict(),
+            'critic_optimizer': self.critic_optimizer.state_dict(),
+            'noise': self.noise.state_dict(),
+            't_step': self.t_step,
+            'learn_step': self.learn_step,
+        })
+
+    def load_state_dict(self, state):
+        """Restore a training state returned by state_dict()."""
+        for name in ('actor_local', 'actor_target', 'critic_local', 'critic_target', 'actor_optimizer', 'critic_optimizer'):
+            getattr(self, name).load_state_dict(state[name])
+        self.noise.load_state_dict(state['noise'])
+        self.t_step, self.learn_step = state['t_step'], state['learn_step']
+
+    def close(self):
+        """The shared memory is closed by its owner."""
+        pass
+
+    def autocast(self):
+        """Return the context in which the local networks run: bfloat16 autocast if enabled."""
+        return bf16_autocast(self.bf16_autocast)
+
+    def learn(self, experiences):
+        """Update all agents' policy and value parameters from one stacked batch.
+
+        Params
+        ======
+            experiences (Experiences): tuple of (s, a, r, s', done) tensors, plus the discounts of
+                n-step experiences, shaped (num_agents, batch_size, ...)
+        """
+        states, actions, rewards, next_states, dones = experiences[:5]
+
+        # ---------------------------- update critics ---------------------------- #
+        actions_next = self.actor_target(next_states)
+        Q_targets_next = self.critic_target(next_states, actions_next)
+        gamma = self.gamma if experiences.discounts is None else experiences.discounts
+        Q_targets = rewards + (gamma * Q_targets_next * (1 - dones))
+        with self.autocast():
+            Q_expected = self.critic_local(states, actions)
+        Q_expected = Q_expected.float()
+        # Sum of the agents' mean squared errors:
+        critic_loss = (Q_expected - Q_targets.detach()).pow(2).mean(dim=(1, 2)).sum()
+        self.critic_optimizer.zero_grad()
+        critic_loss.backward()
+        self.critic_optimizer.step()
+
+        # ---------------------------- update actors ---------------------------- #
+        with self.autocast():
+            actions_pred = self.actor_local(states)
+            actor_loss = -self.critic_local(states, actions_pred).float().mean(dim=(1, 2)).sum()
+        self.actor_optimizer.zero_grad()
+        actor_loss.backward()
+        self.actor_optimizer.step()
+
+        # ----------------------- update target networks ----------------------- #
+        self.learn_step += 1
+        if not self.hard_update_every:
+            self.critic_target.flat_parameters.lerp_(self.critic_local.flat_parameters, self.tau)
+            self.actor_target.flat_parameters.lerp_(self.actor_local.flat_parameters, self.tau)
+        elif self.learn_step % self.hard_update_every == 0:
+            self.critic_target.flat_parameters.copy_(self.critic_local.flat_parameters)
+            self.actor_target.flat_parameters.copy_(self.actor_local.flat_parameters)
@@ -0,0 +1,134 @@
+import argparse
+import random
+import sys
+from collections import namedtuple, deque
+from timeit import default_timer as timer
+
+import numpy as np
+import torch
+
+from model import Actor, Critic, flatten_parameters
+from numpy_actor import NumpyActor
+from replay_buffer import ReplayBuffer
+
+"""
+=============================================================================
+Micro-benchmarks for the hot paths of training and testing.
+=============================================================================
+Run all benchmarks with:  python benchmark.py
+or a single one with:     python benchmark.py replay
+The sizes default to the Tennis environment and the main.py hyperparameters.
+"""
+
+def measure(function, repeats):
+    """Return the mean duration of function() in microseconds, after one warm-up call."""
+    function()
+    start = timer()
+    for _ in range(repeats):
+        function()
+    return (timer() - start) / repeats * 1e6
+
+
+def benchmark_replay(buffer_size=int(1e5), batch_size=512, state_size=48, action_size=2, repeats=200):
+    """
+    Compare sampling from the original deque of namedtuples (rebuilt with np.vstack)
+    against the columnar replay buffer, with float32 and with compressed columns.
+    Prints the sampling time per batch and the memory used by the stored experiences.
+    """
+    rng = np.random.default_rng(0)
+    states = rng.standard_normal((buffer_size, state_size))
+    actions = np.clip(rng.standard_normal((buffer_size, action_size)), -1, 1)
+    rewards = rng.choice([0.0, 0.1, -0.01], size=buffer_size)
+    dones = rng.random(buffer_size) < 0.01
+
+    # The original storage: one namedtuple per experience in a deque
+    experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
+    memory = deque(maxlen=buffer_size)
+    for i in range(buffer_size):
+        memory.append(experience(states[i], actions[i], rewards[i], states[(i + 1) % buffer_size], dones[i]))
+
+    def sample_vstack():
+        experiences = random.sample(memory, k=batch_size)
+        torch.from_numpy(np.vstack([e.state for e in experiences])).float()
+        torch.from_numpy(np.vstack([e.action for e in experiences])).float()
+        torch.from_numpy(np.vstack([e.reward for e in experiences])).float()
+        torch.from_numpy(np.vstack([e.next_state for e in experiences])).float()
+        torch.from_numpy(np.vstack([e.done for e in experiences]).astype(np.uint8)).float()
+
+    # Every experience owns its namedtuple, arrays and reward float, plus a pointer in the deque:
+    e = experience(states[0].copy(), actions[0].copy(), float(rewards[0]), states[1].copy(), bool(dones[0]))
+    vstack_bytes = buffer_size * (sys.getsizeof(e) + sum(sys.getsizeof(field) for field in e[:4]) + 8)
+
+    print("Replay sampling: buffer size {}, batch size {}".format(buffer_size, batch_size))
+    print("  {:<28} {:>10.1f} us/batch  ~{:>7.1f} MB".format("deque + vstack", measure(sample_vstack, repeats), vstack_bytes / 1e6))
+
+    policies = [
+        ("columns float32", None),
+        ("columns float16/int8/bit", {"states": "float16", "actions": "int8", "dones": "bit"}),
+    ]
+    for name, dtypes in policies:
+        buffer = ReplayBuffer(state_size, action_size, buffer_size, batch_size, seed=0, dtypes=dtypes)
+        buffer.add_batch(states, actions, rewards, np.roll(states, -1, axis=0), dones)
+        column_bytes = sum(getattr(buffer, column).nbytes for column in buffer.column_names)
+        print("  {:<28} {:>10.1f} us/batch  ~{:>7.1f} MB".format(name, measure(buffer.sample, repeats), column_bytes / 1e6))
+
+
+def benchmark_soft_update(state_size=48, action_size=2, tau=0.15, repeats=1000):
+    """
+    Compare the per-parameter soft update loop against a single lerp_ over
+    flattened parameters, for the actor and critic networks of model.py.
+    """
+    print("Soft target update: tau {}".format(tau))
+    for name, network in [("actor", Actor), ("critic", Critic)]:
+        local, target = network(state_size, action_size, 0), network(state_size, action_size, 1)
+
+        def update_loop():
+            for target_param, local_param in zip(target.parameters(), local.parameters()):
+                target_param.data.copy_(tau*local_param.data + (1.0-tau)*target_param.data)
+
+        loop_time = measure(update_loop, repeats)
+        local_flat, target_flat = flatten_parameters(local), flatten_parameters(target)
+        fused_time = measure(lambda: target_flat.lerp_(local_flat, tau), repeats)
+        print("  {:<28} {:>10.1f} us/update (loop)  {:>10.1f} us/update (fused)".format(name, loop_time, fused_time))
+
+
+def benchmark_act(state_size=48, action_size=2, num_agents=1, repeats=2000):
+    """
+    Compare the latency of the actor forward pass in act(): eager, TorchScript traced,
+    traced and frozen as done by DDPGAgent.compile_for_inference(), and int8 dynamic
+    quantization as done by DDPGAgent.quantize_for_inference(), and the torch-free NumpyActor.
+    """
+    actor = Actor(state_size, action_size, 0).eval()
+    example = torch.zeros(num_agents, state_size)
+    state = np.random.default_rng(0).standard_normal((num_agents, state_size))
+    with torch.no_grad():
+        traced = torch.jit.trace(actor, example)
+        frozen = torch.jit.freeze(torch.jit.trace(actor, example))
+        quantized = torch.jit.trace(torch.quantization.quantize_dynamic(actor, {torch.nn.Linear}, dtype=torch.qint8), example)
+
+    print("Act latency: {} agent(s), state size {}".format(num_agents, state_size))
+    for name, network in [("eager", actor), ("traced", traced), ("traced + frozen", frozen), ("int8 dynamic", quantized)]:
+        def act():
+            with torch.no_grad():
+                network(torch.from_numpy(np.asarray(state, dtype=np.float32)).view(num_agents, -1)).numpy()
+        print("  {:<28} {:>10.1f} us/act".format(name, measure(act, repeats)))
+    numpy_actor = NumpyActor({key: value.numpy() for key, value in actor.state_dict().items()}, batch_size=num_agents)
+    print("  {:<28} {:>10.1f} us/act".format("numpy", measure(lambda: numpy_actor.act(state), repeats)))
+
+
+benchmarks = {
+    'act': benchmark_act,
+    'replay': benchmark_replay,
+    'soft_update': benchmark_soft_update,
+}
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Run micro-benchmarks for training and testing.")
+    parser.add_argument("names", nargs="*", help="benchmarks to run: {} (default: all)".format(", ".join(sorted(benchmarks))))
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in benchmarks:
+            parser.error("unknown benchmark '{}'".format(name))
+    torch.set_num_threads(1)
+    for name in args.names or sorted(benchmarks):
+        benchmarks[name]()
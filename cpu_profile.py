@@ -0,0 +1,112 @@
+import json
+import os
+from os import makedirs, path
+from timeit import default_timer as timer
+
+import torch
+
+from model import Actor, Critic
+
+"""
+=============================================================================
+CPU execution profile: torch thread pools, CPU affinity and a one-shot autotuner.
+=============================================================================
+Several trainers running on one host each default to one torch thread per core,
+which oversubscribes the cores. The profile fixes the thread pools, optionally pins
+the learner and the Unity process to separate cores, and can pick the fastest
+intra-op thread count and kernel backend by benchmarking the networks once.
+"""
+
+def apply_cpu_profile(hyperparameters, environment=None):
+    """
+    Apply the CPU settings of the hyperparameters to this process and the Unity process
+    of the environment. With CPU_AUTOTUNE the thread count and kernel backend come from
+    the saved autotuner result in the results folder, which is created on the first run.
+    """
+    if hyperparameters.TORCH_INTEROP_THREADS > 0:
+        try:
+            torch.set_num_interop_threads(hyperparameters.TORCH_INTEROP_THREADS)
+        except RuntimeError as error:
+            # Only possible before any inter-op parallel work has started
+            print("Could not set the inter-op threads: {}".format(error))
+    if hyperparameters.LEARNER_CPUS:
+        set_affinity(0, hyperparameters.LEARNER_CPUS)
+    if hyperparameters.UNITY_CPUS and environment is not None:
+        process = environment.env.proc1
+        if process is not None:
+            set_affinity(process.pid, hyperparameters.UNITY_CPUS)
+
+    threads, mkldnn = hyperparameters.TORCH_THREADS, hyperparameters.USE_MKLDNN
+    if hyperparameters.CPU_AUTOTUNE and environment is not None:
+        profile_file = path.join("results", "results_{}".format(hyperparameters.ITERATION), "cpu_profile.json")
+        if path.exists(profile_file):
+            with open(profile_file) as handle:
+                profile = json.load(handle)
+        else:
+            profile = autotune(environment.get_states_per_agent(), environment.get_action_size(),
+                               hyperparameters.BATCH_SIZE, profile_file)
+        threads, mkldnn = profile['threads'], profile['mkldnn']
+    if threads > 0:
+        torch.set_num_threads(threads)
+    torch.backends.mkldnn.enabled = mkldnn
+
+
+def set_affinity(pid, cpus):
+    """Restrict a process (0 = this process) to the given CPU ids, where the OS supports it."""
+    if not hasattr(os, "sched_setaffinity"):
+        print("CPU affinity is not supported on this platform, ignoring it.")
+        return
+    os.sched_setaffinity(pid, cpus)
+
+
+def measure_networks(state_size, action_size, batch_size, repeats):
+    """Return the mean time in seconds of an Actor and Critic forward and backward pass."""
+    actor = Actor(state_size, action_size, 0)
+    critic = Critic(state_size, action_size, 0)
+    states = torch.randn(batch_size, state_size)
+
+    def update():
+        actions = actor(states)
+        critic(states, actions).mean().backward()
+
+    update()
+    start = timer()
+    for _ in range(repeats):
+        update()
+    return (timer() - start) / repeats
+
+
+def autotune(state_size, action_size, batch_size, profile_file, thread_counts=None, repeats=20):
+    """
+    Benchmark the networks at the training batch size under every candidate setting,
+    save the fastest one with all timings to profile_file and return it.
+    The candidates are the intra-op thread counts (powers of two up to the available
+    cores by default) with the oneDNN (mkldnn) kernel backend on and off.
+    """
+    if thread_counts is None:
+        cores = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+        thread_counts = [2 ** i for i in range(cores.bit_length()) if 2 ** i <= cores]
+    backends = [False, True] if torch.backends.mkldnn.is_available() else [False]
+
+    original_threads, original_mkldnn = torch.get_num_threads(), torch.backends.mkldnn.enabled
+    timings = []
+    for threads in thread_counts:
+        for mkldnn in backends:
+            torch.set_num_threads(threads)
+            torch.backends.mkldnn.enabled = mkldnn
+            timings.append({'threads': threads, 'mkldnn': mkldnn,
+                            'seconds': measure_networks(state_size, action_size, batch_size, repeats)})
+    torch.set_num_threads(original_threads)
+    torch.backends.mkldnn.enabled = original_mkldnn
+
+    profile = dict(min(timings, key=lambda timing: timing['seconds']))
+    profile['batch_size'] = batch_size
+    profile['timings'] = timings
+    folder = path.dirname(profile_file)
+    if folder:
+        makedirs(folder, exist_ok=True)
+    with open(profile_file, 'w') as handle:
+        json.dump(profile, handle, indent=2)
+    print("CPU autotuner picked {} threads with mkldnn {}: {:.2f} ms per update".format(
+        profile['threads'], "on" if profile['mkldnn'] else "off", profile['seconds'] * 1000))
+    return profile
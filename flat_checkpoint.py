@@ -0,0 +1,143 @@
+import json
+import os
+import struct
+
+import numpy as np
+import torch
+
+"""
+=============================================================================
+Flat, versioned checkpoint format which loads by memory-mapping.
+=============================================================================
+Layout of a file:
+    magic (8 bytes)            b'DDPGFLAT'
+    version (uint32)           FORMAT_VERSION
+    header length (uint32)     length of the JSON header in bytes
+    header (JSON, UTF-8)       {"tensors": [{"name", "shape", "offset"}, ...], "metadata": {...}}
+    blobs                      raw little-endian float32 data of every tensor, each starting
+                               at its offset from the start of the file (64-byte aligned)
+All integers are little-endian. Loading memory-maps the file copy-on-write and wraps
+every blob as a torch tensor without copying, so the cost of loading is bounded by
+the pages which are actually read. Values which are not tensors, like optimizer
+hyperparameters, are kept in the JSON metadata.
+"""
+
+MAGIC = b'DDPGFLAT'
+FORMAT_VERSION = 1
+ALIGNMENT = 64
+NETWORKS = ('actor_local', 'actor_target', 'critic_local', 'critic_target')
+OPTIMIZERS = ('actor_optimizer', 'critic_optimizer')
+
+def save_flat_checkpoint(file_name, tensors, metadata=None):
+    """
+    Write named float32 tensors and JSON-serialisable metadata to a flat checkpoint.
+    The file is written next to its destination and renamed over it, so readers never see a partial file.
+    """
+    arrays = [(name, np.asarray(tensor.detach().cpu().numpy() if torch.is_tensor(tensor) else tensor, dtype='<f4'))
+              for name, tensor in tensors.items()]
+
+    # The offsets depend on the header length, so lay out the blobs after a header with placeholder offsets:
+    table = [{'name': name, 'shape': list(array.shape), 'offset': 0} for name, array in arrays]
+    header = {'tensors': table, 'metadata': metadata or {}}
+    prefix_length = len(MAGIC) + 8
+    while True:
+        header_length = len(json.dumps(header).encode('utf-8'))
+        offset = align(prefix_length + header_length)
+        for entry, (_, array) in zip(table, arrays):
+            entry['offset'] = offset
+            offset = align(offset + array.nbytes)
+        header_bytes = json.dumps(header).encode('utf-8')
+        if len(header_bytes) == header_length:
+            break
+
+    temporary_file = file_name + '.tmp'
+    with open(temporary_file, 'wb') as handle:
+        handle.write(MAGIC + struct.pack('<II', FORMAT_VERSION, len(header_bytes)) + header_bytes)
+        for entry, (_, array) in zip(table, arrays):
+            handle.seek(entry['offset'])
+            handle.write(array.tobytes())
+        handle.flush()
+        os.fsync(handle.fileno())
+    os.replace(temporary_file, file_name)
+
+
+def load_flat_checkpoint(file_name):
+    """
+    Memory-map a flat checkpoint and return its tensors by name and its metadata.
+    The tensors share the mapped pages; writing to them does not change the file.
+    """
+    with open(file_name, 'rb') as handle:
+        prefix = handle.read(len(MAGIC) + 8)
+        if prefix[:len(MAGIC)] != MAGIC:
+            raise ValueError("{} is not a flat checkpoint".format(file_name))
+        version, header_length = struct.unpack('<II', prefix[len(MAGIC):])
+        if version > FORMAT_VERSION:
+            raise ValueError("{} has format version {}, newer than the supported version {}".format(
+                file_name, version, FORMAT_VERSION))
+        header = json.loads(handle.read(header_length).decode('utf-8'))
+
+    data = np.memmap(file_name, dtype=np.uint8, mode='c')
+    tensors = {}
+    for entry in header['tensors']:
+        count = int(np.prod(entry['shape']))
+        array = data[entry['offset']:entry['offset'] + 4 * count].view('<f4').reshape(tuple(entry['shape']))
+        tensors[entry['name']] = torch.from_numpy(array)
+    return tensors, header['metadata']
+
+
+def align(offset):
+    return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+
+def save_agent(agent, file_name):
+    """
+    Save an agent's local and target networks and its optimizer states to a flat checkpoint.
+    """
+    tensors, metadata = agent_tensors(agent, copy=False)
+    save_flat_checkpoint(file_name, tensors, metadata)
+
+
+def agent_tensors(agent, copy=True):
+    """
+    Return the tensors and metadata save_agent() writes for an agent. With copy the tensors
+    are cloned, so the snapshot can be written while the agent keeps learning.
+    """
+    tensors, metadata = {}, {}
+    for network in NETWORKS:
+        for key, value in getattr(agent, network).state_dict().items():
+            tensors['{}.{}'.format(network, key)] = value.clone() if copy else value
+    for optimizer in OPTIMIZERS:
+        state_dict = getattr(agent, optimizer).state_dict()
+        metadata[optimizer] = {'param_groups': state_dict['param_groups'], 'state': {}}
+        for index, parameter_state in state_dict['state'].items():
+            for key, value in parameter_state.items():
+                if torch.is_tensor(value):
+                    tensors['{}.state.{}.{}'.format(optimizer, index, key)] = value.clone() if copy else value
+                else:
+                    metadata[optimizer]['state'].setdefault(str(index), {})[key] = value
+    return tensors, metadata
+
+
+def load_agent(agent, file_name, networks=NETWORKS, optimizers=OPTIMIZERS):
+    """
+    Load the networks and optimizer states saved by save_agent() into an agent.
+    Only the given networks and optimizers are loaded, e.g. just the actor_local for testing.
+    """
+    tensors, metadata = load_flat_checkpoint(file_name)
+    for network in networks:
+        prefix = network + '.'
+        getattr(agent, network).load_state_dict(
+            {name[len(prefix):]: tensor for name, tensor in tensors.items() if name.startswith(prefix)})
+    for optimizer in optimizers:
+        state = {}
+        for index, values in metadata[optimizer]['state'].items():
+            state.setdefault(int(index), {}).update(values)
+        prefix = optimizer + '.state.'
+        for name, tensor in tensors.items():
+            if name.startswith(prefix):
+                index, key = name[len(prefix):].split('.', 1)
+                state.setdefault(int(index), {})[key] = tensor
+        # JSON turned tuples such as Adam's betas into lists:
+        param_groups = [{key: tuple(value) if key == 'betas' else value for key, value in group.items()}
+                        for group in metadata[optimizer]['param_groups']]
+        getattr(agent, optimizer).load_state_dict({'state': state, 'param_groups': param_groups})
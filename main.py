@@ -1,3 +1,4 @@
+import argparse
 from box import Box
 from trainer import Trainer
 from tester import Tester
@@ -9,15 +10,19 @@ STEP 1: Create the main function
 main() is the entry point into the program.
 It initiliases one of the following clases depending on the mode:
 1) Trainer -> used for training agents
-2) Tester -> used for walking trained agent(s) through an environment
+2) Tester -> used for walking trained agent(s) through an environment,
+   with int8-quantized actors in inference mode
 """
-def main(environment_file_name, hyperparameters, random_seed, train_mode=False):
+def main(environment_file_name, hyperparameters, random_seed, train_mode=False, resume_checkpoint=None, inference=False, export_compiled=False):
     if train_mode:
         trainer = Trainer(environment_file_name, hyperparameters, random_seed=random_seed)
+        if resume_checkpoint is not None:
+            trainer.resume(resume_checkpoint)
         trainer.train()
         trainer.display_final_result()
     else:
-        tester = Tester(environment_file_name, hyperparameters, random_seed=random_seed, games_to_play=10)
+        tester = Tester(environment_file_name, hyperparameters, random_seed=random_seed, games_to_play=10, quantized=inference,
+                        export_compiled=export_compiled)
         tester.load_weights()
         tester.play()
 
@@ -41,19 +46,58 @@ hyperparameters = Box({
     'ITERATION': 8,               # Iteration ID allows to put results into new folders
     'EPISODES': 5000,             # Number of episode to loop through
     'SAVE_EVERY': 100,            # How often to save the agent
+    'SAVE_CHECKPOINT': False,     # Set to True to also save the full training state every SAVE_EVERY episodes, to continue with Trainer.resume() (not bit for bit with PREFETCH_BATCHES or ASYNC_LEARNER)
+    'SAVE_FLAT_CHECKPOINTS': False, # Set to True to also save each agent's networks, targets and optimizers as memory-mappable agent{i}.flat files
+    'ASYNC_SAVE': True,           # Set to True to write the saved models on a background thread, so the environment never waits for the disk
+    'SAVE_MIN_INTERVAL': 10.0,    # Async save config -> minimum seconds between writes; the saves in between are merged into the next write
     'BUFFER_SIZE': int(1e5),      # Replay buffer size
+    'REPLAY_MEMMAP': False,       # Set to True to keep the replay buffer in memory-mapped files under results/results_i
+    'REPLAY_DTYPES': {            # Replay buffer storage per column. Compressed columns are decompressed only when sampled:
+        'states': 'float32',      # 'float32' or 'float16' (also used for next states)
+        'actions': 'float32',     # 'float32' or 'int8' (actions are clipped to [-1, 1])
+        'dones': 'float32'        # 'float32' or 'bit'
+    },
+    'DEDUPLICATE_STATES': False,  # Set to True to store each state once, shared by consecutive experiences (not used with PER, needs N_STEP = 1)
+    'STRATIFIED_FRACTION': 0.0,   # Fraction of each batch sampled from experiences with a non-zero reward or a done (not used with PER)
+    'SHARED_MEMORY': True,        # Set to True for the agents to share one replay buffer which stores the joint state once (not used with PER)
+    'SHARED_SAMPLING': False,     # Set to True for the agents sharing a replay buffer to learn from the same sampled rows (not with PREFETCH_BATCHES or ASYNC_LEARNER)
+    'STACKED_AGENTS': False,      # Set to True for all agents to act and learn together in batched passes over stacked networks (needs SHARED_MEMORY, not with USE_PER, PREFETCH_BATCHES or ASYNC_LEARNER)
     'BATCH_SIZE': 512,            # Training batch size
+    'PREFETCH_BATCHES': 0,        # Number of training batches sampled ahead on a worker thread (0 samples on the training loop)
+    'WARMUP_SIZE': 512,           # Number of experiences the replay memory must exceed before learning starts (at least BATCH_SIZE)
+    'UPDATE_EVERY': 1,            # Number of environment steps between learning triggers
+    'UPDATES_PER_TRIGGER': 1,     # Number of learning updates per trigger, sampled together in one gather
+    'ASYNC_LEARNER': False,       # Set to True for each agent to learn continuously on a background thread while the environment steps
+    'ACTOR_SYNC_EVERY': 10,       # Async learner config -> number of learning updates between syncs of the actor used for acting
+    'MAX_LEARN_RATIO': 1.0,       # Async learner config -> maximum number of learning updates per environment step
     'GAMMA': 0.99,                # Discount factor
+    'N_STEP': 1,                  # Number of rewards summed into each replayed return (1 = standard 1-step DDPG targets)
     'TAU': 0.15,                  # Soft update multiplier
+    'HARD_UPDATE_EVERY': 0,       # Copy the local networks into the targets every N learning updates instead of soft updates (0 = soft updates)
     'LR_ACTOR': 0.00005,          # Learning rate of the actor 
     'LR_CRITIC': 0.0003,          # Learning rate of the critic
     'WEIGHT_DECAY': 0.0000,       # L2 weight decay
+    'BF16_AUTOCAST': False,       # Set to True to run the local networks' forward and backward passes in bfloat16 (fp32 weights and Q targets, needs torch >= 1.10)
     'MU': 0.0,                    # Ornstein-Uhlenbeck config -> the starting state of Ornstein-Uhlenbeck process
     'THETA': 0.15,                # Ornstein-Uhlenbeck config
     'SIGMA': 0.2,                 # Ornstein-Uhlenbeck config -> sigma multiplier
     'USE_SIGMA_DECAY': False,     # Set to True if you want Sigma to decay over time. Then control the decay with min and decay values.
     'SIGMA_MIN': 0.05,            # Ornstein-Uhlenbeck config -> minimum value to which to decay to. 
-    'SIGMA_DECAY': 0.99           # Ornstein-Uhlenbeck config -> decay multiplier to reduce sigma
+    'SIGMA_DECAY': 0.99,          # Ornstein-Uhlenbeck config -> decay multiplier to reduce sigma
+    'NOISE': 'ou',                # Exploration noise process: 'ou' (Ornstein-Uhlenbeck), 'gaussian' or 'decaying' (Gaussian with sigma annealed per step)
+    'NOISE_BLOCK_SIZE': 1024,     # Noise config -> number of steps of noise generated at once for every agent
+    'NOISE_DECAY_STEPS': 100000,  # Noise config -> number of steps over which 'decaying' noise anneals sigma from SIGMA to SIGMA_MIN
+    'USE_PER': False,             # Set to True to sample the replay buffer by priority (Prioritized Experience Replay)
+    'PER_ALPHA': 0.6,             # PER config -> how much prioritization is used (0 = uniform sampling)
+    'PER_BETA': 0.4,              # PER config -> initial importance-sampling correction (1 = full correction)
+    'PER_BETA_INCREMENT': 0.0001, # PER config -> amount beta is annealed towards 1 on every sample
+    'PER_EPSILON': 0.00001,       # PER config -> small constant which keeps every priority above zero
+    'TORCH_THREADS': 0,           # CPU config -> number of intra-op torch threads (0 = torch default of one per core)
+    'TORCH_INTEROP_THREADS': 0,   # CPU config -> number of inter-op torch threads (0 = torch default)
+    'USE_MKLDNN': True,           # CPU config -> set to False to disable the oneDNN (mkldnn) CPU kernels
+    'LEARNER_CPUS': None,         # CPU config -> list of CPU ids to pin the training process to, e.g. [0, 1] (None = no pinning)
+    'UNITY_CPUS': None,           # CPU config -> list of CPU ids to pin the Unity environment process to (None = no pinning)
+    'CPU_AUTOTUNE': False         # CPU config -> set to True to benchmark the thread counts and mkldnn once and use the fastest, saved in results/results_i/cpu_profile.json
 })
     
 # Choose an environment
@@ -69,7 +113,24 @@ STEP 3: Define train/test mode, set a seed, and launch and program
 reproduce results.
 'random_seed' is passed to all the classes used in the program:
 Environment, Agent, OUNoise, ReplayBuffer
+'resume_checkpoint' continues training from a checkpoint saved with SAVE_CHECKPOINT,
+i.e. results/results_i/checkpoint (None starts a new training run).
+With PREFETCH_BATCHES or ASYNC_LEARNER the resumed run does not reproduce an
+uninterrupted one exactly: queued batches are dropped and the sampling threads'
+random draws depend on their timing.
+Running 'python main.py --inference' plays with int8-quantized actors instead of
+training, quantized from the saved fp32 actors in memory.
+Running 'python main.py --export-compiled' plays and saves the TorchScript-compiled actors
+as results/results_i/agent{i}_actor.pt, or agent{i}_actor_int8.pt with --inference.
 """
 train_mode = True
 random_seed=0
-main(environment_file_name, hyperparameters, random_seed, train_mode)
\ No newline at end of file
+resume_checkpoint = None
+
+parser = argparse.ArgumentParser(description="Train or test DDPG agents.")
+parser.add_argument("--inference", action="store_true", help="play with int8-quantized actors instead of training")
+parser.add_argument("--export-compiled", action="store_true", help="play and save the TorchScript-compiled (or with --inference, int8) actors instead of training")
+args = parser.parse_args()
+if args.inference or args.export_compiled:
+    train_mode = False
+main(environment_file_name, hyperparameters, random_seed, train_mode, resume_checkpoint, args.inference, args.export_compiled)
\ No newline at end of file
@@ -8,6 +8,26 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 
+def has_mode_dependent_layers(module):
+    """Return True if the module contains layers which behave differently in train() and eval() mode."""
+    return any(isinstance(m, (nn.Dropout, nn.modules.batchnorm._BatchNorm)) for m in module.modules())
+
+def flatten_parameters(module):
+    """Move the parameters of a module into one contiguous flat tensor and return it.
+
+    Every parameter becomes a view into the flat tensor, so the whole module can be
+    updated with a single tensor operation. Call it after moving the module to its
+    device: .to() would allocate new, separate parameter tensors again.
+    """
+    parameters = list(module.parameters())
+    flat = torch.cat([p.data.reshape(-1) for p in parameters])
+    offset = 0
+    for p in parameters:
+        p.data = flat[offset:offset + p.numel()].view_as(p)
+        offset += p.numel()
+    module.flat_parameters = flat
+    return flat
+
 def hidden_init(layer):
     fan_in = layer.weight.data.size()[0]
     lim = 1. / np.sqrt(fan_in)
@@ -79,4 +99,102 @@ class Critic(nn.Module):
         x = torch.cat((xs, action), dim=1)
         x = F.relu(self.fc2(x))
         x = self.dropout(x)
-        return self.fc3(x)
\ No newline at end of file
+        return self.fc3(x)
+
+class StackedLinear(nn.Module):
+    """A linear layer per agent, stored as stacked weights with a leading agent dimension.
+
+    Inputs are shaped (num_agents, batch, in_features) and all agents' layers are
+    applied in one batched matrix multiply: y_i = x_i W_i + b_i.
+    """
+
+    def __init__(self, linears):
+        """Stack the weights of one nn.Linear per agent.
+        Params
+        ======
+            linears (list of nn.Linear): the agents' layers, all of the same size
+        """
+        super(StackedLinear, self).__init__()
+        self.weight = nn.Parameter(torch.stack([linear.weight.data.t() for linear in linears]))
+        self.bias = nn.Parameter(torch.stack([linear.bias.data.unsqueeze(0) for linear in linears]))
+
+    def forward(self, x):
+        return torch.baddbmm(self.bias, x, self.weight)
+
+
+class StackedNetwork(nn.Module):
+    """Base class of the stacked networks, which converts one agent's layers to and
+    from the state dict of the matching single-agent network."""
+
+    def agent_state_dict(self, agent_index):
+        """Return one agent's weights as the state dict of the single-agent network."""
+        state_dict = {}
+        for name, layer in self.named_children():
+            if isinstance(layer, StackedLinear):
+                state_dict[name + '.weight'] = layer.weight.data[agent_index].t().clone()
+                state_dict[name + '.bias'] = layer.bias.data[agent_index, 0].clone()
+        return state_dict
+
+    def load_agent_state_dict(self, agent_index, state_dict):
+        """Load the state dict of a single-agent network into one agent's weights."""
+        for name, layer in self.named_children():
+            if isinstance(layer, StackedLinear):
+                layer.weight.data[agent_index] = state_dict[name + '.weight'].t()
+                layer.bias.data[agent_index, 0] = state_dict[name + '.bias']
+
+
+class StackedActor(StackedNetwork):
+    """Actor (Policy) Models of several agents, evaluated together."""
+
+    def __init__(self, num_agents, state_size, action_size, seed, fc1_units=512, fc2_units=256):
+        """Initialize each agent's parameters as in Actor and stack them.
+        Params
+        ======
+            num_agents (int): Number of agents
+            state_size (int): Dimension of each state
+            action_size (int): Dimension of each action
+            seed (int): Random seed
+            fc1_units (int): Number of nodes in first hidden layer
+            fc2_units (int): Number of nodes in second hidden layer
+        """
+        super(StackedActor, self).__init__()
+        actors = [Actor(state_size, action_size, seed, fc1_units, fc2_units) for _ in range(num_agents)]
+        self.fc1 = StackedLinear([actor.fc1 for actor in actors])
+        self.fc2 = StackedLinear([actor.fc2 for actor in actors])
+        self.fc3 = StackedLinear([actor.fc3 for actor in actors])
+
+    def forward(self, state):
+        """Map each agent's states (num_agents, batch, state_size) -> actions."""
+        x = F.relu(self.fc1(state))
+        x = F.relu(self.fc2(x))
+        return torch.tanh(self.fc3(x))
+
+
+class StackedCritic(StackedNetwork):
+    """Critic (Value) Models of several agents, evaluated together."""
+
+    def __init__(self, num_agents, state_size, action_size, seed, fcs1_units=512, fc2_units=256, dropout=0.2):
+        """Initialize each agent's parameters as in Critic and stack them.
+        Params
+        ======
+            num_agents (int): Number of agents
+            state_size (int): Dimension of each state
+            action_size (int): Dimension of each action
+            seed (int): Random seed
+            fcs1_units (int): Number of nodes in the first hidden layer
+            fc2_units (int): Number of nodes in the second hidden layer
+        """
+        super(StackedCritic, self).__init__()
+        critics = [Critic(state_size, action_size, seed, fcs1_units, fc2_units, dropout) for _ in range(num_agents)]
+        self.dropout = nn.Dropout(p=dropout)
+        self.fcs1 = StackedLinear([critic.fcs1 for critic in critics])
+        self.fc2 = StackedLinear([critic.fc2 for critic in critics])
+        self.fc3 = StackedLinear([critic.fc3 for critic in critics])
+
+    def forward(self, state, action):
+        """Map each agent's (state, action) pairs (num_agents, batch, ...) -> Q-values."""
+        xs = F.relu(self.fcs1(state))
+        x = torch.cat((xs, action), dim=2)
+        x = F.relu(self.fc2(x))
+        x = self.dropout(x)
+        return self.fc3(x)
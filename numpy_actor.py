@@ -0,0 +1,122 @@
+import pickle
+import zipfile
+from collections import OrderedDict
+
+import numpy as np
+
+"""
+=============================================================================
+Torch-free actor inference with NumPy.
+=============================================================================
+Evaluation workers only need the actor's forward pass. Importing torch takes
+seconds and hundreds of MB per process, so this module reads the agent*_actor.pth
+files written by torch.save() (a zip archive holding data.pkl and one raw file per
+storage under data/) with the standard library, and runs the Actor MLP of model.py
+(fc1/relu, fc2/relu, fc3/tanh) with NumPy in preallocated buffers.
+"""
+
+# Storage types referenced by the pickled state dicts, with their little-endian dtypes:
+STORAGE_DTYPES = {
+    'FloatStorage': '<f4',
+    'DoubleStorage': '<f8',
+    'HalfStorage': '<f2',
+    'LongStorage': '<i8',
+    'IntStorage': '<i4',
+    'ShortStorage': '<i2',
+    'CharStorage': 'i1',
+    'ByteStorage': 'u1',
+    'BoolStorage': '?',
+}
+
+def rebuild_tensor(storage, storage_offset, size, stride, *args):
+    """Build the array of a tensor as a view of its storage, as torch._utils._rebuild_tensor_v2 does."""
+    itemsize = storage.dtype.itemsize
+    return np.lib.stride_tricks.as_strided(storage[storage_offset:], shape=tuple(size),
+                                           strides=tuple(s * itemsize for s in stride))
+
+def rebuild_parameter(data, *args):
+    return data
+
+
+class StateDictUnpickler(pickle.Unpickler):
+    """Unpickles a torch state dict into NumPy arrays, reading the storages from the zip archive."""
+
+    def __init__(self, archive, prefix):
+        self.archive = archive
+        self.prefix = prefix
+        self.storages = {}
+        super(StateDictUnpickler, self).__init__(archive.open(prefix + 'data.pkl'))
+
+    def find_class(self, module, name):
+        if (module, name) == ('collections', 'OrderedDict'):
+            return OrderedDict
+        if (module, name) == ('torch._utils', '_rebuild_tensor_v2'):
+            return rebuild_tensor
+        if (module, name) == ('torch._utils', '_rebuild_parameter'):
+            return rebuild_parameter
+        if module == 'torch' and name in STORAGE_DTYPES:
+            return STORAGE_DTYPES[name]
+        raise pickle.UnpicklingError("Unsupported object in a state dict: {}.{}".format(module, name))
+
+    def persistent_load(self, saved_id):
+        # ('storage', storage type, key, location, number of elements)
+        _, dtype, key, _, _ = saved_id
+        if key not in self.storages:
+            data = self.archive.read('{}data/{}'.format(self.prefix, key))
+            self.storages[key] = np.frombuffer(data, dtype=dtype)
+        return self.storages[key]
+
+
+def load_state_dict(file_name):
+    """Load a state dict saved with torch.save() as a dictionary of NumPy arrays, without torch."""
+    with zipfile.ZipFile(file_name) as archive:
+        data_file = next(name for name in archive.namelist() if name.endswith('data.pkl'))
+        prefix = data_file[:-len('data.pkl')]
+        state_dict = StateDictUnpickler(archive, prefix).load()
+    return OrderedDict((key, np.array(value, dtype=np.float32)) for key, value in state_dict.items())
+
+
+class NumpyActor():
+    """Actor (Policy) Model of model.py evaluated with NumPy.
+
+    The weights are stored transposed and contiguous, and the activations of each
+    layer are written into buffers which are reused for every batch of the same size.
+    """
+
+    def __init__(self, state_dict, batch_size=1):
+        """Initialize the actor from an Actor state dict of NumPy arrays.
+        Params
+        ======
+            state_dict (dict): fc1/fc2/fc3 weights and biases, as returned by load_state_dict()
+            batch_size (int): number of states per call to preallocate the buffers for
+        """
+        self.weights = [np.ascontiguousarray(state_dict['fc{}.weight'.format(i)].T) for i in (1, 2, 3)]
+        self.biases = [state_dict['fc{}.bias'.format(i)] for i in (1, 2, 3)]
+        self.state_size = self.weights[0].shape[0]
+        self.allocate(batch_size)
+
+    @classmethod
+    def from_file(cls, file_name, batch_size=1):
+        """Load an actor from an agent*_actor.pth file."""
+        return cls(load_state_dict(file_name), batch_size)
+
+    def allocate(self, batch_size):
+        """Preallocate the output buffers of the three layers."""
+        self.batch_size = batch_size
+        self.buffers = [np.empty((batch_size, weight.shape[1]), dtype=np.float32) for weight in self.weights]
+
+    def act(self, states):
+        """Map states -> actions. The returned array is reused by the next call, so copy it if it needs to be kept."""
+        states = np.asarray(states, dtype=np.float32).reshape(-1, self.state_size)
+        if len(states) != self.batch_size:
+            self.allocate(len(states))
+        x = states
+        for layer, (weight, bias, buffer) in enumerate(zip(self.weights, self.biases, self.buffers)):
+            np.matmul(x, weight, out=buffer)
+            buffer += bias
+            if layer < 2:
+                np.maximum(buffer, 0, out=buffer)
+            else:
+                np.tanh(buffer, out=buffer)
+            x = buffer
+        return x
@@ -2,35 +2,216 @@
 Code adapted and expanded from the original Udacity code project.
 """
 
-import copy
-import random
 import numpy as np
 
-class OUNoise:
-    """Ornstein-Uhlenbeck process."""
+"""
+=============================================================================
+Exploration noise processes, generated in precomputed blocks.
+=============================================================================
+Every process owns one np.random.Generator per agent (row of the noise), seeded
+from the random seed and the agent's index, so each agent has an independent
+stream which does not depend on the global NumPy state or on how the agents are
+grouped into DDPGAgent/MultiAgentDDPG objects. The random numbers of the next
+NOISE_BLOCK_SIZE steps are drawn in one call per agent, and sample() only reads
+the next row of the block into a reused buffer.
+"""
 
-    def __init__(self, size, hyperparameters, seed):
-        """Initialize parameters and noise process."""
-        self.mu = hyperparameters.MU * np.ones(size)
-        self.theta = hyperparameters.THETA
+# Largest factor by which the scaled terms of the vectorized OU recursion may grow within a block:
+MAX_BLOCK_GROWTH = 1e100
+
+class NoiseProcess():
+    """Base class of the noise processes: per-agent generators, blocks and sigma decay."""
+
+    def __init__(self, size, hyperparameters, seed, streams=None):
+        """Initialize parameters and noise process.
+        Params
+        ======
+            size (tuple): (number of agents, action size)
+            hyperparameters (Box): MU, SIGMA, USE_SIGMA_DECAY, SIGMA_MIN, SIGMA_DECAY and NOISE_BLOCK_SIZE
+            seed (int): random seed
+            streams (list): index of the random stream of each agent (default: 0, 1, ...)
+        """
+        self.size = tuple(size)
+        self.mu = hyperparameters.MU * np.ones(self.size)
         self.sigma = hyperparameters.SIGMA
         self.use_sigma_decay = hyperparameters.USE_SIGMA_DECAY
         self.sigma_min = hyperparameters.SIGMA_MIN
         self.sigma_decay = hyperparameters.SIGMA_DECAY
-        self.seed = random.seed(seed)
-        self.size = size
-        self.reset()
+        self.block_size = hyperparameters.NOISE_BLOCK_SIZE
+        # The original OUNoise called reset() on construction, which decayed sigma once:
+        if self.use_sigma_decay:
+            self.sigma = max(self.sigma_min, self.sigma * self.sigma_decay)
+        streams = range(self.size[0]) if streams is None else streams
+        self.generators = [np.random.default_rng([seed, stream]) for stream in streams]
+        self.sample_buffer = np.empty(self.size)
+        # Position of the next sample in the block; the first sample() draws the first block:
+        self.block = np.zeros((0,) + self.size)
+        self.position = 0
+
+    def standard_normal(self, steps):
+        """Draw standard normal numbers for the next steps of every agent, shaped (steps, *size)."""
+        return np.stack([generator.standard_normal((steps,) + self.size[1:]) for generator in self.generators], axis=1)
 
     def reset(self):
-        """Reset the internal state (= noise) to mean (mu)."""
-        self.state = copy.copy(self.mu)
-        """Resduce  sigma from initial value to min if decay is enabled"""
+        """Reduce sigma from its initial value to the minimum if decay is enabled."""
         if self.use_sigma_decay:
-            self.sigma = max(self.sigma_min, self.sigma*self.sigma_decay)
+            self.sigma = max(self.sigma_min, self.sigma * self.sigma_decay)
 
     def sample(self):
-        """Update internal state and return it as a noise sample."""
-        x = self.state
-        dx = self.theta * (self.mu - x) + self.sigma * np.random.standard_normal(self.size)
-        self.state = x + dx
-        return self.state
\ No newline at end of file
+        """Return the next noise sample. The returned array is reused by the next call."""
+        if self.position == len(self.block):
+            self.next_block()
+        self.fill_sample(self.position)
+        self.position += 1
+        return self.sample_buffer
+
+    def state_dict(self):
+        """Return the process state, including the generators, to be restored with load_state_dict()."""
+        return {'sigma': self.sigma,
+                'block': np.copy(self.block),
+                'position': self.position,
+                'generators': [generator.bit_generator.state for generator in self.generators]}
+
+    def load_state_dict(self, state):
+        self.sigma = state['sigma']
+        self.block = np.copy(state['block'])
+        self.position = state['position']
+        for generator, generator_state in zip(self.generators, state['generators']):
+            generator.bit_generator.state = generator_state
+
+
+class GaussianNoise(NoiseProcess):
+    """Uncorrelated Gaussian noise around mu."""
+
+    def next_block(self):
+        self.block = self.standard_normal(self.block_size)
+        self.position = 0
+
+    def fill_sample(self, position):
+        np.multiply(self.block[position], self.sigma, out=self.sample_buffer)
+        self.sample_buffer += self.mu
+
+
+class DecayingNoise(GaussianNoise):
+    """Gaussian noise whose sigma is annealed linearly from SIGMA to SIGMA_MIN over NOISE_DECAY_STEPS steps.
+
+    The sigma of every step of a block is computed with the block, so the episodic
+    USE_SIGMA_DECAY is not used.
+    """
+
+    def __init__(self, size, hyperparameters, seed, streams=None):
+        super(DecayingNoise, self).__init__(size, hyperparameters, seed, streams)
+        self.sigma_start = self.sigma = hyperparameters.SIGMA
+        self.decay_steps = hyperparameters.NOISE_DECAY_STEPS
+        self.steps = 0
+
+    def next_block(self):
+        super(DecayingNoise, self).next_block()
+        progress = np.minimum((self.steps + np.arange(self.block_size)) / self.decay_steps, 1.0)
+        sigmas = self.sigma_start + (self.sigma_min - self.sigma_start) * progress
+        self.block *= sigmas.reshape((-1,) + (1,) * len(self.size))
+        self.sigmas = sigmas
+
+    def reset(self):
+        pass
+
+    def fill_sample(self, position):
+        np.add(self.block[position], self.mu, out=self.sample_buffer)
+        self.sigma = self.sigmas[position]
+        self.steps += 1
+
+    def state_dict(self):
+        state = super(DecayingNoise, self).state_dict()
+        state['steps'] = self.steps
+        return state
+
+    def load_state_dict(self, state):
+        super(DecayingNoise, self).load_state_dict(state)
+        self.steps = state['steps']
+        # The sigmas of the restored block are recomputed from the first step of the block:
+        progress = np.minimum((self.steps - self.position + np.arange(len(self.block))) / self.decay_steps, 1.0)
+        self.sigmas = self.sigma_start + (self.sigma_min - self.sigma_start) * progress
+
+
+class OUNoise(NoiseProcess):
+    """Ornstein-Uhlenbeck process.
+
+    With a = 1 - theta the process is x[t+1] - mu = a * (x[t] - mu) + sigma * e[t]. The
+    block holds the unit-sigma path Z of the noise alone, Z[0] = 0 and Z[k+1] = a * Z[k] + e[k],
+    computed for all steps at once in closed form. Since sigma only changes on reset(),
+    where x returns to mu, every sample is x[t] = mu + sigma * Z[t] + a ** (t - anchor) * carry,
+    where the carry absorbs the state at the anchor (the last reset or the block start).
+    """
+
+    def __init__(self, size, hyperparameters, seed, streams=None):
+        super(OUNoise, self).__init__(size, hyperparameters, seed, streams)
+        self.theta = hyperparameters.THETA
+        if not 0 <= self.theta < 1:
+            raise ValueError("THETA must be in [0, 1) for the Ornstein-Uhlenbeck process, got {}".format(self.theta))
+        decay = 1 - self.theta
+        if decay < 1:
+            # The closed form scales the step e[i] by a ** -i, which must stay finite:
+            self.block_size = max(1, min(self.block_size, int(np.log(MAX_BLOCK_GROWTH) / -np.log(decay))))
+        self.powers = decay ** np.arange(self.block_size + 1)
+        self.carry = np.zeros(self.size)
+        self.anchor = 0
+
+    def next_block(self):
+        steps = len(self.block) - 1
+        if steps > 0:
+            # Carry the state at the end of the block, x[T] - mu, over to the start of the next one:
+            self.carry *= self.powers[steps - self.anchor]
+            self.carry += self.sigma * self.block[steps]
+        noise = self.standard_normal(self.block_size)
+        shape = (-1,) + (1,) * len(self.size)
+        # Z[k] = a ** (k - 1) * sum(a ** -i * e[i] for i < k):
+        scaled_sums = np.cumsum(noise / self.powers[:-1].reshape(shape), axis=0)
+        self.block = np.zeros((self.block_size + 1,) + self.size)
+        np.multiply(scaled_sums, self.powers[:-1].reshape(shape), out=self.block[1:])
+        self.anchor = 0
+        self.position = 0
+
+    def reset(self):
+        """Reset the internal state (= noise) to mean (mu)."""
+        super(OUNoise, self).reset()
+        if len(self.block) == 0:
+            self.next_block()
+        np.multiply(self.block[self.position], -self.sigma, out=self.carry)
+        self.anchor = self.position
+
+    def sample(self):
+        """Update internal state and return it as a noise sample. The returned array is reused by the next call."""
+        # The state after the first step of a block is Z[1], so the last row of a block is Z[T]:
+        if self.position + 1 >= len(self.block):
+            self.next_block()
+        self.position += 1
+        self.fill_sample(self.position)
+        return self.sample_buffer
+
+    def fill_sample(self, position):
+        np.multiply(self.block[position], self.sigma, out=self.sample_buffer)
+        self.sample_buffer += self.mu
+        self.sample_buffer += self.powers[position - self.anchor] * self.carry
+
+    def state_dict(self):
+        state = super(OUNoise, self).state_dict()
+        state.update(carry=np.copy(self.carry), anchor=self.anchor)
+        return state
+
+    def load_state_dict(self, state):
+        super(OUNoise, self).load_state_dict(state)
+        self.carry = np.copy(state['carry'])
+        self.anchor = state['anchor']
+
+
+NOISE_PROCESSES = {
+    'ou': OUNoise,
+    'gaussian': GaussianNoise,
+    'decaying': DecayingNoise,
+}
+
+def make_noise(size, hyperparameters, seed, streams=None):
+    """Create the noise process selected by hyperparameters.NOISE."""
+    if hyperparameters.NOISE not in NOISE_PROCESSES:
+        raise ValueError("Unknown NOISE {}, expected one of {}".format(hyperparameters.NOISE, sorted(NOISE_PROCESSES)))
+    return NOISE_PROCESSES[hyperparameters.NOISE](size, hyperparameters, seed, streams)
@@ -5,44 +5,917 @@ Code adapted and expanded from the original Udacity code project.
 import torch
 import numpy as np
 import random
-from collections import namedtuple, deque
+import pickle
+import shutil
+import threading
+import queue
+from collections import namedtuple
+from os import makedirs, path
+from tempfile import mkdtemp
 
 # Determine if CPU or GPU computation should be used
 device = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 
+# A sampled minibatch. Buffers which store n-step transitions also return the discount
+# of each next state, and prioritized buffers fill in the importance-sampling weights
+# and the buffer indices needed to update the priorities after learning.
+Experiences = namedtuple("Experiences",
+                         field_names=["states", "actions", "rewards", "next_states", "dones", "discounts", "weights", "indices"],
+                         defaults=[None, None, None])
+
+def split_experiences(experiences, count):
+    """Split a batch gathered for several updates into count equal batches (views, not copies)."""
+    fields = [None if field is None else (field.chunk(count) if torch.is_tensor(field) else np.split(field, count))
+              for field in experiences]
+    return [Experiences(*(None if field is None else field[i] for field in fields)) for i in range(count)]
+
+class CompressedColumn:
+    """Column whose stored array differs from the float32 values it reads back."""
+
+    def __init__(self, data):
+        self.data = data
+        self.dtype = data.dtype
+        self.nbytes = data.nbytes
+
+
+class HalfPrecisionColumn(CompressedColumn):
+    """Column stored as float16 which reads back as float32."""
+
+    def __setitem__(self, key, values):
+        self.data[key] = values
+
+    def __getitem__(self, key):
+        return self.data[key].astype(np.float32)
+
+
+class QuantizedColumn(CompressedColumn):
+    """Column of values in [-1, 1] stored as int8 multiples of 1/127."""
+
+    def __setitem__(self, key, values):
+        self.data[key] = np.rint(np.clip(values, -1, 1) * 127)
+
+    def __getitem__(self, key):
+        return self.data[key].astype(np.float32) / 127
+
+
+class BitColumn(CompressedColumn):
+    """Column of booleans packed eight to a byte which reads back as float32 zeros and ones.
+
+    Supports the keys used by the replay buffers: rows (slice or index array),
+    optionally followed by a slice of columns.
+    """
+
+    def __init__(self, data, shape):
+        super(BitColumn, self).__init__(data)
+        self.shape = shape
+
+    def bit_positions(self, key):
+        rows, columns = key if isinstance(key, tuple) else (key, slice(None))
+        if isinstance(rows, slice):
+            rows = np.arange(*rows.indices(self.shape[0]))
+        columns = np.arange(self.shape[1])[columns]
+        return np.reshape(rows, (-1, 1)) * self.shape[1] + columns
+
+    def __setitem__(self, key, values):
+        positions = self.bit_positions(key)
+        values = np.broadcast_to(np.asarray(values, dtype=bool), positions.shape)
+        positions = positions.ravel()
+        masks = np.left_shift(1, positions & 7).astype(np.uint8)
+        # ufunc.at applies every update even when several bits share a byte
+        np.bitwise_and.at(self.data, positions >> 3, ~masks)
+        np.bitwise_or.at(self.data, positions >> 3, masks * values.ravel())
+
+    def __getitem__(self, key):
+        positions = self.bit_positions(key)
+        return ((self.data[positions >> 3] >> (positions & 7)) & 1).astype(np.float32)
+
+
+class SparseRewardIndex:
+    """Set of buffer rows which hold a non-zero reward or a done.
+
+    Rows are kept in a dense array with each row's position stored alongside, so
+    adding, removing (by swapping with the last entry) and uniform sampling are O(1)
+    per row.
+    """
+
+    def __init__(self, capacity):
+        self.rows = np.zeros(capacity, dtype=np.int64)
+        self.positions = np.full(capacity, -1, dtype=np.int64)
+        self.count = 0
+
+    def add(self, rows):
+        """Add rows which are not in the index yet."""
+        end = self.count + len(rows)
+        self.rows[self.count:end] = rows
+        self.positions[rows] = np.arange(self.count, end)
+        self.count = end
+
+    def discard(self, rows):
+        """Remove the given rows, ignoring rows which are not in the index."""
+        for row in rows[self.positions[rows] >= 0]:
+            position = self.positions[row]
+            last = self.rows[self.count - 1]
+            self.rows[position] = last
+            self.positions[last] = position
+            self.positions[row] = -1
+            self.count -= 1
+
+    def sample(self, rng, count):
+        """Return count rows drawn uniformly from the index."""
+        return self.rows[rng.integers(0, self.count, size=count)]
+
+    def __len__(self):
+        return self.count
+
+
+def create_storage_dir(iteration):
+    """Create a private directory for memory-mapped replay columns in the results folder of an iteration."""
+    results_folder = path.join("results", "results_{}".format(iteration))
+    makedirs(results_folder, exist_ok=True)
+    return mkdtemp(prefix="replay_", dir=results_folder)
+
 class ReplayBuffer:
-    """Fixed-size buffer to store experience tuples."""
+    """Fixed-size buffer to store experience tuples.
+
+    Experiences are stored column by column in preallocated float32 arrays which
+    are used as a ring: once the buffer is full the oldest rows are overwritten.
+    If a storage directory is given the columns are numpy memmaps backed by files
+    in that directory, so the buffer can grow beyond the available RAM.
 
-    def __init__(self, action_size, buffer_size, batch_size, seed):
+    Columns can be stored in a compressed form which is decompressed to float32
+    only for the sampled rows. The dtypes dictionary selects the policy per column:
+        states (used for next_states too): 'float32' or 'float16'
+        actions: 'float32' or 'int8' (actions must lie in [-1, 1])
+        dones: 'float32' or 'bit'
+
+    With deduplicate_states, states and next states are kept once in a ring of
+    observations and every experience stores the indices of its two observations.
+    Within an episode an experience's state is the previous experience's next state,
+    so the two share one observation and only about one observation is stored per
+    experience. The observation ring is a quarter larger than the buffer to hold the
+    extra observations at episode boundaries; if it still runs out, the oldest
+    experiences are dropped before their observations are overwritten.
+
+    With a stratified fraction, the rows holding a non-zero reward or a done are
+    tracked in a SparseRewardIndex and that fraction of every sampled batch is drawn
+    from them, so sparse rewards are not drowned out by all-zero batches.
+    """
+
+    def __init__(self, state_size, action_size, buffer_size, batch_size, seed, storage_dir=None, dtypes=None,
+                 store_discounts=False, deduplicate_states=False, stratified_fraction=0.0):
         """Initialize a ReplayBuffer object.
         Params
         ======
+            state_size (int): dimension of each state
+            action_size (int): dimension of each action
             buffer_size (int): maximum size of buffer
             batch_size (int): size of each training batch
+            seed (int): random seed
+            storage_dir (str): directory for memory-mapped columns (None keeps them in RAM)
+            dtypes (dict): storage policy per column (None stores every column as float32)
+            store_discounts (bool): keep the discount of each next state, as needed for n-step returns
+            deduplicate_states (bool): store each observation once and chain experiences through indices
+            stratified_fraction (float): fraction of each batch sampled from rows with a non-zero reward or a done
         """
+        self.state_size = state_size
         self.action_size = action_size
-        self.memory = deque(maxlen=buffer_size)  
+        self.buffer_size = int(buffer_size)
         self.batch_size = batch_size
-        self.experience = namedtuple("Experience", field_names=["state", "action", "reward", "next_state", "done"])
         self.seed = random.seed(seed)
-    
+        self.rng = np.random.default_rng(seed)
+        self.storage_dir = storage_dir
+        self.dtypes = dict(dtypes or {})
+        self.store_discounts = store_discounts
+        self.deduplicate_states = deduplicate_states
+        self.stratified_fraction = stratified_fraction
+        self.column_names = []
+        self.allocate_columns()
+        self.sparse_index = SparseRewardIndex(self.buffer_size) if stratified_fraction > 0 else None
+
+        # Guards the buffer when it is sampled from another thread (see BatchPrefetcher):
+        self.lock = threading.Lock()
+
+        # Write cursor and number of rows currently filled:
+        self.position = 0
+        self.size = 0
+
+    def allocate_columns(self):
+        """Preallocate the columns, one row per experience."""
+        self.allocate_states()
+        self.actions = self.allocate_column("actions", (self.buffer_size, self.action_size), self.dtypes.get("actions"))
+        self.rewards = self.allocate_column("rewards", (self.buffer_size, 1))
+        self.dones = self.allocate_column("dones", (self.buffer_size, 1), self.dtypes.get("dones"))
+        self.discounts = self.allocate_column("discounts", (self.buffer_size, 1)) if self.store_discounts else None
+
+    def allocate_states(self):
+        """Preallocate the state and next state columns, or the observation ring and its indices."""
+        if not self.deduplicate_states:
+            self.states = self.allocate_column("states", (self.buffer_size, self.state_size), self.dtypes.get("states"))
+            self.next_states = self.allocate_column("next_states", (self.buffer_size, self.state_size), self.dtypes.get("states"))
+            return
+        self.observation_capacity = self.buffer_size + max(self.buffer_size // 4, 2)
+        self.observations = self.allocate_column("observations", (self.observation_capacity, self.state_size), self.dtypes.get("states"))
+        self.state_indices = self.allocate("state_indices", (self.buffer_size,), np.int32)
+        self.next_state_indices = self.allocate("next_state_indices", (self.buffer_size,), np.int32)
+        self.observation_position = 0
+        # Observation holding each row's latest next state, or -1 once the row's episode is done:
+        self.chain_tails = None
+
+    def allocate_column(self, name, shape, policy=None):
+        """Create a zeroed column which stores its values according to a dtype policy."""
+        if policy in (None, "float32"):
+            return self.allocate(name, shape, np.float32)
+        if policy == "float16":
+            return HalfPrecisionColumn(self.allocate(name, shape, np.float16))
+        if policy == "int8":
+            return QuantizedColumn(self.allocate(name, shape, np.int8))
+        if policy == "bit":
+            return BitColumn(self.allocate(name, ((int(np.prod(shape)) + 7) // 8,), np.uint8), shape)
+        raise ValueError("Unknown dtype policy '{}' for the {} column".format(policy, name))
+
+    def allocate(self, name, shape, dtype):
+        """Create a zeroed array, memory-mapped to a file if a storage directory is set."""
+        self.column_names.append(name)
+        if self.storage_dir is None:
+            return np.zeros(shape, dtype=dtype)
+        return np.memmap(path.join(self.storage_dir, "{}.dat".format(name)), dtype=dtype, mode="w+", shape=shape)
+
+    def raw_array(self, name):
+        """Return the array in which a column is stored, compressed or not."""
+        column = getattr(self, name)
+        return column.data if isinstance(column, CompressedColumn) else column
+
+    def state_dict(self):
+        """Return the buffer state apart from its columns: cursors, sampling RNG and indices."""
+        state = {'position': self.position, 'size': self.size, 'rng': self.rng.bit_generator.state}
+        if self.deduplicate_states:
+            state['observation_position'] = self.observation_position
+            state['chain_tails'] = self.chain_tails
+        if self.sparse_index is not None:
+            state['sparse_index'] = (self.sparse_index.rows, self.sparse_index.positions, self.sparse_index.count)
+        return state
+
+    def load_state_dict(self, state):
+        self.position, self.size = state['position'], state['size']
+        self.rng.bit_generator.state = state['rng']
+        if self.deduplicate_states:
+            self.observation_position = state['observation_position']
+            self.chain_tails = state['chain_tails']
+        if self.sparse_index is not None:
+            rows, positions, self.sparse_index.count = state['sparse_index']
+            self.sparse_index.rows[:] = rows
+            self.sparse_index.positions[:] = positions
+
+    def save(self, folder):
+        """Write the buffer to a folder: every column as a raw .npy array, and the rest of its state."""
+        makedirs(folder, exist_ok=True)
+        for name in self.column_names:
+            np.save(path.join(folder, "{}.npy".format(name)), self.raw_array(name))
+        with open(path.join(folder, "state.pickle"), "wb") as handle:
+            pickle.dump(self.state_dict(), handle, protocol=pickle.HIGHEST_PROTOCOL)
+
+    def load(self, folder):
+        """Restore a buffer written by save() into this buffer, which must have the same configuration."""
+        for name in self.column_names:
+            self.raw_array(name)[...] = np.load(path.join(folder, "{}.npy".format(name)), mmap_mode="r")
+        with open(path.join(folder, "state.pickle"), "rb") as handle:
+            self.load_state_dict(pickle.load(handle))
+
+    def close(self):
+        """Release the memory-mapped columns and delete their files."""
+        if self.storage_dir is not None:
+            for name in self.column_names:
+                setattr(self, name, None)
+            shutil.rmtree(self.storage_dir, ignore_errors=True)
+            self.storage_dir = None
+
     def add(self, state, action, reward, next_state, done):
         """Add a new experience to memory."""
-        e = self.experience(state, action, reward, next_state, done)
-        self.memory.append(e)
-    
+        self.add_batch(state, action, [reward], next_state, [done])
+
+    def add_batch(self, states, actions, rewards, next_states, dones, discounts=None):
+        """Add N experiences to memory at once, one row per experience."""
+        n = np.size(rewards)
+        rows = self.claim_rows(n)
+        self.write_states(rows, np.reshape(states, (n, self.state_size)), np.reshape(next_states, (n, self.state_size)), dones)
+        self.actions[rows] = np.reshape(actions, (n, self.action_size))
+        self.rewards[rows] = np.reshape(rewards, (n, 1))
+        self.dones[rows] = np.reshape(dones, (n, 1))
+        if self.store_discounts:
+            self.discounts[rows] = np.reshape(discounts, (n, 1))
+        self.update_sparse_index(rows, rewards, dones)
+
+    def update_sparse_index(self, rows, rewards, dones):
+        """Replace the overwritten rows in the sparse reward index with the new rows which are sparse."""
+        if self.sparse_index is None:
+            return
+        rows = np.arange(rows.start, rows.stop) if isinstance(rows, slice) else rows
+        self.sparse_index.discard(rows)
+        sparse = (np.reshape(rewards, (len(rows), -1)) != 0).any(axis=1) | np.reshape(dones, (len(rows), -1)).any(axis=1)
+        self.sparse_index.add(rows[sparse])
+
+    def claim_rows(self, n):
+        """Advance the write cursor by n rows and return the rows to write to.
+
+        Returns a slice unless the rows wrap around the end of the ring.
+        """
+        start = self.position
+        if start + n <= self.buffer_size:
+            rows = slice(start, start + n)
+        else:
+            rows = np.arange(start, start + n) % self.buffer_size
+        self.position = (start + n) % self.buffer_size
+        self.size = min(self.size + n, self.buffer_size)
+        return rows
+
+    def write_states(self, rows, states, next_states, dones):
+        """Store the states and next states of the experiences at the given rows."""
+        if not self.deduplicate_states:
+            self.states[rows] = states
+            self.next_states[rows] = next_states
+            return
+
+        # A row's state continues its chain if it equals the next state stored for the row by the previous add:
+        n = len(states)
+        state_slots = np.full(n, -1)
+        if self.chain_tails is not None and len(self.chain_tails) == n:
+            state_slots[:] = self.chain_tails
+        live = np.flatnonzero(state_slots >= 0)
+        continues = np.all(self.observations[state_slots[live]] == states[live].astype(self.observations.dtype), axis=1)
+        state_slots[live[~continues]] = -1
+        new_states = np.flatnonzero(state_slots < 0)
+
+        # Store the states which start a new chain and every next state:
+        slots = self.claim_observations(len(new_states) + n, n)
+        state_slots[new_states] = slots[:len(new_states)]
+        next_slots = slots[len(new_states):]
+        self.observations[slots] = np.concatenate((states[new_states], next_states))
+        self.state_indices[rows] = state_slots
+        self.next_state_indices[rows] = next_slots
+
+        # The next add continues each row's chain unless its episode is done:
+        done_rows = np.reshape(dones, (n, -1)).any(axis=1)
+        self.chain_tails = np.where(done_rows, -1, next_slots)
+
+    def claim_observations(self, k, new_rows):
+        """Advance the observation cursor by k slots and return the slots to write to.
+
+        Drops the oldest experiences, other than the new_rows just claimed, whose
+        state is stored in one of the slots. Observations are claimed in order, so
+        the states of later experiences are never more than one add (at most
+        2*new_rows observations) older than the state of the oldest experience;
+        experiences whose state is that close to being overwritten are dropped too.
+        """
+        start = self.observation_position
+        slots = (start + np.arange(k)) % self.observation_capacity
+        self.observation_position = (start + k) % self.observation_capacity
+        while self.size > new_rows:
+            oldest = (self.position - self.size) % self.buffer_size
+            if (self.state_indices[oldest] - start) % self.observation_capacity >= k + 2 * new_rows:
+                break
+            if self.sparse_index is not None:
+                self.sparse_index.discard(np.array([oldest]))
+            self.size -= 1
+        return slots
+
+    def read_states(self, indices):
+        """Return the states and next states stored at the given rows."""
+        if not self.deduplicate_states:
+            return self.states[indices], self.next_states[indices]
+        return self.observations[self.state_indices[indices]], self.observations[self.next_state_indices[indices]]
+
+    def random_rows(self, count):
+        """Return count rows drawn uniformly from the filled part of the ring."""
+        return (self.position - self.size + self.rng.integers(0, self.size, size=count)) % self.buffer_size
+
+    def sample_rows(self, batches=1):
+        """Return the rows of one or more consecutive batches, with the stratified fraction
+        of each batch drawn from the sparse reward index."""
+        if self.sparse_index is None or len(self.sparse_index) == 0:
+            indices = self.random_rows(batches * self.batch_size).reshape(batches, self.batch_size)
+        else:
+            sparse_count = int(round(self.stratified_fraction * self.batch_size))
+            indices = np.concatenate((self.sparse_index.sample(self.rng, batches * sparse_count).reshape(batches, sparse_count),
+                                      self.random_rows(batches * (self.batch_size - sparse_count)).reshape(batches, -1)), axis=1)
+        if self.storage_dir is not None:
+            # Gather memory-mapped rows in file order to keep page-cache access sequential
+            indices.sort(axis=1)
+        return indices.reshape(-1)
+
     def sample(self):
         """Randomly sample a batch of experiences from memory."""
-        experiences = random.sample(self.memory, k=self.batch_size)
+        return self.gather(self.sample_rows())
+
+    def sample_batches(self, count):
+        """Randomly sample count batches of experiences with a single gather."""
+        return split_experiences(self.gather(self.sample_rows(count)), count)
 
-        states = torch.from_numpy(np.vstack([e.state for e in experiences if e is not None])).float().to(device)
-        actions = torch.from_numpy(np.vstack([e.action for e in experiences if e is not None])).float().to(device)
-        rewards = torch.from_numpy(np.vstack([e.reward for e in experiences if e is not None])).float().to(device)
-        next_states = torch.from_numpy(np.vstack([e.next_state for e in experiences if e is not None])).float().to(device)
-        dones = torch.from_numpy(np.vstack([e.done for e in experiences if e is not None]).astype(np.uint8)).float().to(device)
+    def gather(self, indices):
+        """Return the experiences stored at the given rows as torch tensors."""
+        states, next_states = self.read_states(indices)
+        states = torch.from_numpy(states).to(device)
+        actions = torch.from_numpy(self.actions[indices]).to(device)
+        rewards = torch.from_numpy(self.rewards[indices]).to(device)
+        next_states = torch.from_numpy(next_states).to(device)
+        dones = torch.from_numpy(self.dones[indices]).to(device)
+        discounts = torch.from_numpy(self.discounts[indices]).to(device) if self.store_discounts else None
 
-        return (states, actions, rewards, next_states, dones)
+        return Experiences(states, actions, rewards, next_states, dones, discounts)
 
     def __len__(self):
         """Return the current size of internal memory."""
-        return len(self.memory)
\ No newline at end of file
+        return self.size
+
+
+class MultiAgentReplayBuffer(ReplayBuffer):
+    """Replay buffer shared by several agents which observe the same joint state.
+
+    Each row holds one joint transition: the joint state and next state are stored
+    once, next to per-agent action, reward and done columns. Every agent samples
+    its own view of the buffer through view(agent_index).
+    """
+
+    def __init__(self, num_agents, state_size, action_size, buffer_size, batch_size, seed,
+                 storage_dir=None, dtypes=None, store_discounts=False, deduplicate_states=False, stratified_fraction=0.0,
+                 same_indices=False):
+        """Initialize a MultiAgentReplayBuffer object.
+        Params
+        ======
+            num_agents (int): number of agents sharing the buffer
+            state_size (int): dimension of the joint state
+            action_size (int): dimension of each agent's action
+            same_indices (bool): if True all agents learn from the same rows in each round of sampling
+        """
+        self.num_agents = num_agents
+        self.same_indices = same_indices
+        self.indices = None
+        self.agents_sampled = set()
+        super(MultiAgentReplayBuffer, self).__init__(state_size, action_size, buffer_size, batch_size, seed,
+                                                     storage_dir, dtypes, store_discounts, deduplicate_states, stratified_fraction)
+
+    def allocate_columns(self):
+        """Preallocate the joint state columns once and the remaining columns per agent."""
+        self.allocate_states()
+        self.actions = self.allocate_column("actions", (self.buffer_size, self.num_agents, self.action_size), self.dtypes.get("actions"))
+        self.rewards = self.allocate_column("rewards", (self.buffer_size, self.num_agents))
+        self.dones = self.allocate_column("dones", (self.buffer_size, self.num_agents), self.dtypes.get("dones"))
+        self.discounts = self.allocate_column("discounts", (self.buffer_size, self.num_agents)) if self.store_discounts else None
+
+    def add(self, states, actions, rewards, next_states, dones, discounts=None):
+        """Add a joint experience with one action, reward and done per agent."""
+        self.add_batch(states, actions, rewards, next_states, dones, discounts)
+
+    def add_batch(self, states, actions, rewards, next_states, dones, discounts=None):
+        """Add N joint experiences to memory at once."""
+        n = np.size(rewards) // self.num_agents
+        rows = self.claim_rows(n)
+        self.write_states(rows, np.reshape(states, (n, self.state_size)), np.reshape(next_states, (n, self.state_size)), dones)
+        self.actions[rows] = np.reshape(actions, (n, self.num_agents, self.action_size))
+        self.rewards[rows] = np.reshape(rewards, (n, self.num_agents))
+        self.dones[rows] = np.reshape(dones, (n, self.num_agents))
+        if self.store_discounts:
+            self.discounts[rows] = np.reshape(discounts, (n, self.num_agents))
+        self.update_sparse_index(rows, rewards, dones)
+
+    def sample(self, agent_index=0):
+        """Randomly sample a batch of experiences as seen by one agent."""
+        if not self.same_indices or self.indices is None or agent_index in self.agents_sampled:
+            self.indices = self.sample_rows()
+            self.agents_sampled = set()
+        self.agents_sampled.add(agent_index)
+        return self.gather(self.indices, agent_index)
+
+    def sample_batches(self, count, agent_index=0):
+        """Randomly sample count batches of one agent's experiences with a single gather."""
+        if not self.same_indices or self.indices is None or agent_index in self.agents_sampled:
+            self.indices = self.sample_rows(count)
+            self.agents_sampled = set()
+        self.agents_sampled.add(agent_index)
+        return split_experiences(self.gather(self.indices, agent_index), count)
+
+    def gather(self, indices, agent_index=0):
+        """Return one agent's experiences stored at the given rows as torch tensors."""
+        states, next_states = self.read_states(indices)
+        states = torch.from_numpy(states).to(device)
+        actions = torch.from_numpy(self.actions[indices, agent_index]).to(device)
+        rewards = torch.from_numpy(self.rewards[indices, agent_index:agent_index + 1]).to(device)
+        next_states = torch.from_numpy(next_states).to(device)
+        dones = torch.from_numpy(self.dones[indices, agent_index:agent_index + 1]).to(device)
+        discounts = None
+        if self.store_discounts:
+            discounts = torch.from_numpy(self.discounts[indices, agent_index:agent_index + 1]).to(device)
+
+        return Experiences(states, actions, rewards, next_states, dones, discounts)
+
+    def state_dict(self):
+        state = super(MultiAgentReplayBuffer, self).state_dict()
+        state['sampling'] = (self.indices, self.agents_sampled)
+        return state
+
+    def load_state_dict(self, state):
+        super(MultiAgentReplayBuffer, self).load_state_dict(state)
+        self.indices, self.agents_sampled = state['sampling']
+
+    def sample_agents(self, batches=1):
+        """Randomly sample batches for all agents at once, stacked along a leading agent dimension.
+
+        Returns a list of Experiences whose tensors are shaped (num_agents, batch_size, ...).
+        With same_indices all agents see the same rows, otherwise each agent has its own.
+        """
+        if self.same_indices:
+            indices = self.sample_rows(batches).reshape(batches, 1, self.batch_size)
+            indices = np.repeat(indices, self.num_agents, axis=1)
+        else:
+            indices = self.sample_rows(batches * self.num_agents).reshape(batches, self.num_agents, self.batch_size)
+        return self.gather_agents(indices)
+
+    def gather_agents(self, indices):
+        """Return the experiences at rows shaped (batches, num_agents, batch_size), with row
+        indices[b, i] read as agent i sees it, as a list of one stacked batch per leading index."""
+        rows = indices.reshape(-1)
+        agents = np.broadcast_to(np.arange(self.num_agents)[:, None], indices.shape).reshape(-1)
+        every_row = np.arange(len(rows))
+        states, next_states = self.read_states(rows)
+        columns = [states,
+                   self.actions[rows][every_row, agents],
+                   self.rewards[rows][every_row, agents],
+                   next_states,
+                   self.dones[rows][every_row, agents]]
+        if self.store_discounts:
+            columns.append(self.discounts[rows][every_row, agents])
+        tensors = []
+        for column in columns:
+            # Rewards, dones and discounts get a trailing dimension of 1, as in gather():
+            column = np.reshape(column, indices.shape + (-1,))
+            tensors.append(torch.from_numpy(np.ascontiguousarray(column, dtype=np.float32)).to(device))
+        return [Experiences(*(tensor[i] for tensor in tensors)) for i in range(indices.shape[0])]
+
+    def view(self, agent_index):
+        """Return the replay memory as seen by one agent."""
+        return AgentReplayView(self, agent_index)
+
+
+class AgentReplayView:
+    """One agent's read-only view of a MultiAgentReplayBuffer.
+
+    The view is used as the agent's memory: it samples the agent's own columns and
+    leaves adding experiences and closing the buffer to the owner of the buffer.
+    """
+
+    def __init__(self, buffer, agent_index):
+        self.buffer = buffer
+        self.agent_index = agent_index
+        self.batch_size = buffer.batch_size
+        self.lock = buffer.lock
+
+    def sample(self):
+        """Randomly sample a batch of this agent's experiences."""
+        return self.buffer.sample(self.agent_index)
+
+    def sample_batches(self, count):
+        """Randomly sample count batches of this agent's experiences with a single gather."""
+        return self.buffer.sample_batches(count, self.agent_index)
+
+    def close(self):
+        """The shared buffer is closed by its owner."""
+        pass
+
+    def __len__(self):
+        return len(self.buffer)
+
+
+class NStepAccumulator:
+    """Builds n-step transitions from consecutive 1-step transitions as they arrive.
+
+    The last n transitions are kept in a rolling window. Once the window is full
+    every new step emits the transition which started n steps ago:
+        (s_t, a_t, r_t + γ*r_t+1 + ... + γ^(n-1)*r_t+n-1, s_t+n, done, γ^n)
+    When an episode ends all pending transitions are flushed with their shorter
+    returns and matching discounts. Every step may hold several rows (one per
+    agent); rewards and dones hold one value per row or per agent.
+
+    The window is a ring of n preallocated slots, each holding a pending transition's
+    state, action and partial return. A new reward is added to every slot's return in
+    one vectorized update, weighted by γ^age of the slot, so a step costs the same
+    whatever n is; only a done walks the window to flush it.
+    """
+
+    def __init__(self, n_step, gamma):
+        """Initialize an NStepAccumulator object.
+        Params
+        ======
+            n_step (int): number of rewards summed into each return
+            gamma (float): discount factor
+        """
+        self.n_step = n_step
+        self.gamma = gamma
+        powers = gamma ** np.arange(n_step)
+        # weights[tail, slot]: γ^age of the transition in a slot when the newest step is in slot tail
+        # (the weights of empty slots do not matter, as a slot's return is cleared when it is reused):
+        self.weights = powers[(np.arange(n_step)[:, None] - np.arange(n_step)[None, :]) % n_step]
+        self.discounts = gamma ** np.arange(n_step + 1)
+        self.states = None
+        self.head = 0           # Slot of the oldest pending transition
+        self.count = 0          # Number of pending transitions
+
+    def allocate(self, states, actions, rewards):
+        """Preallocate the slots for steps shaped like the first one."""
+        self.states = np.empty((self.n_step,) + states.shape, dtype=states.dtype)
+        self.actions = np.empty((self.n_step,) + actions.shape, dtype=actions.dtype)
+        self.returns = np.zeros((self.n_step,) + rewards.shape)
+
+    def reset(self):
+        """Discard pending transitions, e.g. at the start of a new episode."""
+        self.head = 0
+        self.count = 0
+
+    def push(self, states, actions, rewards, next_states, dones):
+        """Add a step and return the n-step transitions it completes (None if there are none)."""
+        states, actions = np.atleast_2d(np.asarray(states)), np.atleast_2d(np.asarray(actions))
+        rewards = np.atleast_1d(np.asarray(rewards, dtype=np.float64))
+        if self.states is None:
+            self.allocate(states, actions, rewards)
+        # Copy the step into its slot, as callers may reuse their arrays (see DDPGAgent.act):
+        tail = (self.head + self.count) % self.n_step
+        self.states[tail] = states
+        self.actions[tail] = actions
+        self.returns[tail] = 0
+        self.returns += self.weights[tail].reshape((-1,) + (1,) * rewards.ndim) * rewards
+        self.count += 1
+        dones = np.atleast_1d(dones)
+
+        if np.any(dones):
+            # Flush the window, oldest first. Each transition bootstraps from the newest next state:
+            slots = (self.head + np.arange(self.count)) % self.n_step
+            discounts = self.discounts[self.count - np.arange(self.count)]
+            count = self.count
+            self.reset()
+            return (self.states[slots].reshape((-1,) + states.shape[1:]),
+                    self.actions[slots].reshape((-1,) + actions.shape[1:]),
+                    self.returns[slots].reshape(-1),
+                    np.tile(np.atleast_2d(next_states), (count, 1)),
+                    np.tile(dones, count),
+                    np.repeat(discounts, rewards.size))
+        if self.count < self.n_step:
+            return None
+
+        head = self.head
+        self.head = (self.head + 1) % self.n_step
+        self.count -= 1
+        return (self.states[head].copy(),
+                self.actions[head].copy(),
+                self.returns[head].reshape(-1).copy(),
+                np.atleast_2d(np.array(next_states)),
+                dones,
+                np.full(rewards.size, self.discounts[self.n_step]))
+
+    def state_dict(self):
+        """Return the pending transitions, to be restored with load_state_dict()."""
+        if self.states is None:
+            return {'slots': None}
+        return {'slots': (self.states.copy(), self.actions.copy(), self.returns.copy()),
+                'head': self.head, 'count': self.count}
+
+    def load_state_dict(self, state):
+        self.reset()
+        if state['slots'] is not None:
+            self.states, self.actions, self.returns = (np.copy(array) for array in state['slots'])
+            self.head, self.count = state['head'], state['count']
+
+    def __len__(self):
+        return self.count
+
+
+class BatchPrefetcher:
+    """Samples minibatches from a replay memory on a worker thread.
+
+    Ready-made batches are kept in a small bounded queue, so the learner only has to
+    dequeue one instead of sampling and building tensors on the critical path. The
+    prefetcher stands in for the memory it wraps: writes go through it and are
+    serialised with the worker thread by the memory's lock.
+    """
+
+    def __init__(self, memory, queue_size=2, min_size=0):
+        """Initialize a BatchPrefetcher object and start its worker thread.
+        Params
+        ======
+            memory: replay memory to sample from
+            queue_size (int): maximum number of batches sampled ahead
+            min_size (int): number of experiences the memory must exceed before sampling starts
+        """
+        self.memory = memory
+        self.batch_size = memory.batch_size
+        self.min_size = min_size
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.batches = 0        # Batches handed to the learner
+        self.waits = 0          # Times the learner found the queue empty and had to wait
+        self.error = None
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self.run, name="BatchPrefetcher", daemon=True)
+        self.thread.start()
+
+    def run(self):
+        """Keep the queue filled with sampled batches until closed."""
+        try:
+            while not self.stop_event.is_set():
+                if len(self.memory) <= self.min_size:
+                    self.stop_event.wait(0.001)
+                    continue
+                with self.memory.lock:
+                    experiences = self.memory.sample()
+                while not self.stop_event.is_set():
+                    try:
+                        self.queue.put(experiences, timeout=0.1)
+                        break
+                    except queue.Full:
+                        pass
+        except Exception as error:
+            self.error = error
+
+    def sample(self):
+        """Return the next prefetched batch, waiting for the worker if none is ready.
+        Raises a RuntimeError if the worker failed or the prefetcher was closed."""
+        try:
+            experiences = self.queue.get_nowait()
+        except queue.Empty:
+            self.waits += 1
+            while True:
+                if self.error is not None:
+                    raise RuntimeError("the batch prefetcher failed") from self.error
+                if self.stop_event.is_set():
+                    raise RuntimeError("the batch prefetcher is closed")
+                try:
+                    experiences = self.queue.get(timeout=0.1)
+                    break
+                except queue.Empty:
+                    pass
+        self.batches += 1
+        return experiences
+
+    def sample_batches(self, count):
+        """Return the next count prefetched batches."""
+        return [self.sample() for _ in range(count)]
+
+    def add(self, *experience):
+        with self.memory.lock:
+            self.memory.add(*experience)
+
+    def add_batch(self, *experiences, **kwargs):
+        with self.memory.lock:
+            self.memory.add_batch(*experiences, **kwargs)
+
+    def update_priorities(self, indices, td_errors):
+        with self.memory.lock:
+            self.memory.update_priorities(indices, td_errors)
+
+    def close(self):
+        """Stop the worker thread and close the wrapped memory."""
+        self.stop_event.set()
+        self.thread.join()
+        self.memory.close()
+
+    def __len__(self):
+        return len(self.memory)
+
+
+class SegmentTree:
+    """Array-backed binary tree which aggregates its leaves with a numpy ufunc.
+
+    Leaves live at tree[capacity:2*capacity] and node i aggregates its children
+    2*i and 2*i+1, so tree[1] holds the aggregate over all leaves. Updates are
+    applied to a whole batch of leaves at once, one tree level at a time.
+    """
+
+    def __init__(self, capacity, operation, neutral_element):
+        self.capacity = 1
+        while self.capacity < capacity:
+            self.capacity *= 2
+        self.operation = operation
+        self.tree = np.full(2 * self.capacity, neutral_element, dtype=np.float64)
+
+    def update(self, indices, values):
+        """Set the leaves at indices to values and refresh their ancestors."""
+        nodes = np.asarray(indices) + self.capacity
+        self.tree[nodes] = values
+        while nodes[0] > 1:
+            nodes = np.unique(nodes // 2)
+            self.tree[nodes] = self.operation(self.tree[2 * nodes], self.tree[2 * nodes + 1])
+
+    def total(self):
+        """Return the aggregate over all leaves."""
+        return self.tree[1]
+
+    def __getitem__(self, indices):
+        return self.tree[np.asarray(indices) + self.capacity]
+
+
+class SumTree(SegmentTree):
+    """Segment tree of sums which supports proportional (prefix-sum) lookups."""
+
+    def __init__(self, capacity):
+        super(SumTree, self).__init__(capacity, np.add, 0.0)
+
+    def find_prefix_sum(self, prefix_sums):
+        """For each prefix sum return the first leaf whose cumulative sum exceeds it."""
+        nodes = np.ones(len(prefix_sums), dtype=np.int64)
+        prefix_sums = np.array(prefix_sums, dtype=np.float64)
+        while nodes[0] < self.capacity:
+            left = 2 * nodes
+            left_sums = self.tree[left]
+            go_right = prefix_sums > left_sums
+            prefix_sums -= left_sums * go_right
+            nodes = left + go_right
+        return nodes - self.capacity
+
+
+class MinTree(SegmentTree):
+    """Segment tree of minimums, used for the largest importance-sampling weight."""
+
+    def __init__(self, capacity):
+        super(MinTree, self).__init__(capacity, np.minimum, np.inf)
+
+
+class PrioritizedReplayBuffer(ReplayBuffer):
+    """Replay buffer which samples experiences proportionally to their priority.
+
+    Priorities are stored as p_i = (|delta_i| + epsilon)^alpha in a sum-tree for
+    O(log N) proportional sampling and a min-tree for normalising the
+    importance-sampling weights w_i = (N * P(i))^-beta / max_j w_j.
+    """
+
+    def __init__(self, state_size, action_size, buffer_size, batch_size, seed, storage_dir=None, dtypes=None,
+                 store_discounts=False, alpha=0.6, beta=0.4, beta_increment=0.0001, epsilon=1e-5):
+        """Initialize a PrioritizedReplayBuffer object.
+        Params
+        ======
+            alpha (float): how much prioritization is used (0 = uniform)
+            beta (float): initial importance-sampling correction (1 = full correction)
+            beta_increment (float): amount beta is annealed towards 1 after every sample
+            epsilon (float): small constant which keeps every priority above zero
+        """
+        super(PrioritizedReplayBuffer, self).__init__(state_size, action_size, buffer_size, batch_size, seed,
+                                                      storage_dir, dtypes, store_discounts)
+        self.alpha = alpha
+        self.beta = beta
+        self.beta_increment = beta_increment
+        self.epsilon = epsilon
+        self.max_priority = 1.0
+        self.sum_tree = SumTree(self.buffer_size)
+        self.min_tree = MinTree(self.buffer_size)
+
+    def add_batch(self, states, actions, rewards, next_states, dones, discounts=None):
+        """Add N experiences to memory with the highest priority seen so far."""
+        rows = (self.position + np.arange(np.size(rewards))) % self.buffer_size
+        super(PrioritizedReplayBuffer, self).add_batch(states, actions, rewards, next_states, dones, discounts)
+        self.set_priorities(rows, self.max_priority ** self.alpha)
+
+    def state_dict(self):
+        state = super(PrioritizedReplayBuffer, self).state_dict()
+        state['priorities'] = (self.sum_tree.tree, self.min_tree.tree, self.max_priority, self.beta)
+        return state
+
+    def load_state_dict(self, state):
+        super(PrioritizedReplayBuffer, self).load_state_dict(state)
+        sum_tree, min_tree, self.max_priority, self.beta = state['priorities']
+        self.sum_tree.tree[:] = sum_tree
+        self.min_tree.tree[:] = min_tree
+
+    def set_priorities(self, indices, priorities):
+        self.sum_tree.update(indices, priorities)
+        self.min_tree.update(indices, priorities)
+
+    def sample(self):
+        """Sample a batch of experiences proportionally to their priorities."""
+        return self.sample_batches(1)[0]
+
+    def sample_batches(self, count):
+        """Sample count batches of experiences proportionally to their priorities with a single gather.
+
+        All batches are drawn from the current priorities, so the updates of one trigger
+        do not see each other's priority refreshes.
+        """
+        # Split the total priority into equal segments and draw one sample per segment:
+        rows = count * self.batch_size
+        total = self.sum_tree.total()
+        segment = total / rows
+        prefix_sums = (np.arange(rows) + self.rng.random(rows)) * segment
+        # Deal the segments out in turn, so every batch spans the whole priority range. The
+        # prefix sums of each batch are increasing, so its indices come out in file order:
+        prefix_sums = prefix_sums.reshape(self.batch_size, count).T.reshape(-1)
+        indices = np.minimum(self.sum_tree.find_prefix_sum(prefix_sums), self.size - 1)
+
+        # Importance-sampling weights, normalised by the largest possible weight:
+        probabilities = self.sum_tree[indices] / total
+        min_probability = self.min_tree.total() / total
+        weights = (probabilities / min_probability) ** -self.beta
+        self.beta = min(1.0, self.beta + count * self.beta_increment)
+
+        experiences = self.gather(indices)
+        weights = torch.from_numpy(weights.astype(np.float32)).unsqueeze(1).to(device)
+        return split_experiences(experiences._replace(weights=weights, indices=indices), count)
+
+    def update_priorities(self, indices, td_errors):
+        """Update the priorities of sampled experiences from their TD errors."""
+        priorities = np.abs(np.reshape(td_errors, -1)) + self.epsilon
+        self.max_priority = max(self.max_priority, priorities.max())
+        self.set_priorities(indices, priorities ** self.alpha)
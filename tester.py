@@ -1,7 +1,10 @@
 import numpy as np
 import torch
+from os import path
 from agent import DDPGAgent
 from environment import Environment
+from cpu_profile import apply_cpu_profile
+from flat_checkpoint import load_agent
 
 class Tester():
     """
@@ -10,36 +13,70 @@ class Tester():
     
     Methods
     ====
-        load_weights(): allows to load save network model weights for the actor and critic.
+        load_weights(): allows to load save network model weights for the actor and critic,
+            and compiles the actors for inference in memory (saved as agent{i}_actor.pt with export_compiled).
+        load_quantized_actors(): quantizes the actors to int8 instead (saved as agent{i}_actor_int8.pt with export_compiled).
         play(): walks the the initialised environment for N amount of episodes. Shows this visually.
     """
-    def __init__(self, environment_file_name, hyperparameters, random_seed=0, games_to_play=10):
+    def __init__(self, environment_file_name, hyperparameters, random_seed=0, games_to_play=10, quantized=False, export_compiled=False):
         self.env = Environment(file_name=environment_file_name, seed=random_seed, train_mode=False, no_graphics=False)
-        
-        # Create the agents which will play against each other:
-        self.agent1 = DDPGAgent(state_size=self.env.get_states_per_agent(),
-                                action_size=self.env.get_action_size(),
-                                hyperparameters=hyperparameters,
-                                num_agents=1,
-                                random_seed=random_seed)
-        self.agent2 = DDPGAgent(state_size=self.env.get_states_per_agent(),
-                                action_size=self.env.get_action_size(),
-                                hyperparameters=hyperparameters,
-                                num_agents=1,
-                                random_seed=random_seed)
+        apply_cpu_profile(hyperparameters, self.env)
+
+        # The agents only act, so build them without the training machinery of the hyperparameters:
+        # no asynchronous learner or prefetch threads, and a small replay buffer in memory:
+        hyperparameters = hyperparameters.copy()
+        hyperparameters.update(ASYNC_LEARNER=False, PREFETCH_BATCHES=0, REPLAY_MEMMAP=False,
+                               BUFFER_SIZE=hyperparameters.BATCH_SIZE)
+
+        # Create the agents which will play against each other, one per agent of the environment:
+        self.agents = [DDPGAgent(state_size=self.env.get_states_per_agent(),
+                                 action_size=self.env.get_action_size(),
+                                 hyperparameters=hyperparameters,
+                                 num_agents=1,
+                                 random_seed=random_seed,
+                                 agent_index=i)
+                       for i in range(self.env.get_num_of_agents())]
+        # Every agent's actions of a step, one row per agent:
+        self.actions = np.zeros((self.env.get_num_of_agents(), self.env.get_action_size()))
         self.games_to_play = games_to_play
+        self.quantized = quantized
+        self.export_compiled = export_compiled
     
     def load_weights(self):
         """
         Load trained model weights into the initialised agents.
         """
         #TODO: Move the weights file selection to main.py
-        self.agent1.actor_local.load_state_dict(torch.load('results/results_7/agent1_actor.pth'))
-        self.agent1.critic_local.load_state_dict(torch.load('results/results_7/agent1_critic.pth'))
+        results_folder = 'results/results_7'
+        if self.quantized:
+            self.load_quantized_actors(results_folder)
+            return
+
+        for i, agent in enumerate(self.agents, start=1):
+            # Memory-map the flat checkpoints if they were saved, otherwise unpickle the weights:
+            flat_checkpoint = path.join(results_folder, 'agent{}.flat'.format(i))
+            if path.exists(flat_checkpoint):
+                load_agent(agent, flat_checkpoint, networks=('actor_local', 'critic_local'), optimizers=())
+            else:
+                agent.actor_local.load_state_dict(torch.load(path.join(results_folder, 'agent{}_actor.pth'.format(i))))
+                agent.critic_local.load_state_dict(torch.load(path.join(results_folder, 'agent{}_critic.pth'.format(i))))
 
-        self.agent2.actor_local.load_state_dict(torch.load('results/results_7/agent2_actor.pth'))
-        self.agent2.critic_local.load_state_dict(torch.load('results/results_7/agent2_critic.pth'))
+            # Act through TorchScript-compiled actors. Only export them next to the weights when asked to,
+            # so that evaluation runs leave the results folder untouched:
+            compiled_actor = path.join(results_folder, 'agent{}_actor.pt'.format(i)) if self.export_compiled else None
+            agent.compile_for_inference(path=compiled_actor)
     
+    def load_quantized_actors(self, results_folder):
+        """
+        Quantize the saved fp32 actors to int8 in memory. They are always quantized from the
+        current agent{i}_actor.pth, so a retrained actor is never replaced by a stale int8 copy.
+        """
+        for i, agent in enumerate(self.agents, start=1):
+            agent.actor_local.load_state_dict(torch.load(path.join(results_folder, 'agent{}_actor.pth'.format(i))))
+            quantized_actor = path.join(results_folder, 'agent{}_actor_int8.pt'.format(i)) if self.export_compiled else None
+            _, deviation = agent.quantize_for_inference(path=quantized_actor)
+            print("Quantized the actor of agent {} to int8: max action deviation from fp32 {:.5f}".format(i, deviation))
+
     def play(self):
         """
         Walk trained agents through a pre-defined number of episodes.
@@ -61,14 +98,12 @@ class Tester():
             # 3) the environment retuns the next state, rewards, dones
             # 4) scores are updated
             while True:
-                # Get the first agent actions based on current state, using noise for exploration:
-                actions1 = self.agent1.act(states, add_noise=False)
-                actions2 = self.agent2.act(states, add_noise=False)
+                # Get every agent's actions based on current state, without noise:
+                for i, agent in enumerate(self.agents):
+                    self.actions[i] = agent.act(states, add_noise=False)[0]
 
-                # Concatenate actions and reshape the data. Then send these actions to the environment:
-                actions = np.concatenate((actions1, actions2), axis=0) 
-                actions = np.reshape(actions, (1, 4))
-                self.env.step(actions)
+                # Send the actions of all agents to the environment as one row:
+                self.env.step(np.reshape(self.actions, (1, -1)))
 
                 # Get a response from the environment:
                 next_states = self.env.states      
@@ -86,5 +121,7 @@ class Tester():
                 if np.any(dones):
                     break
         
-        # Close environment after game has finished.
-        self.env.close()
\ No newline at end of file
+        # Close environment and release the agents' resources after game has finished.
+        self.env.close()
+        for agent in self.agents:
+            agent.close()
\ No newline at end of file
@@ -0,0 +1,182 @@
+import time
+
+import numpy as np
+import pytest
+import torch
+from box import Box
+
+from agent import DDPGAgent
+from ounoise import make_noise
+from replay_buffer import MultiAgentReplayBuffer
+
+
+def make_hyperparameters(**overrides):
+    hyperparameters = Box({
+        'ITERATION': 0, 'EPISODES': 4, 'SAVE_EVERY': 2, 'SAVE_CHECKPOINT': False, 'SAVE_FLAT_CHECKPOINTS': False,
+        'ASYNC_SAVE': True, 'SAVE_MIN_INTERVAL': 0.0,
+        'BUFFER_SIZE': 1000, 'REPLAY_MEMMAP': False, 'REPLAY_DTYPES': {},
+        'DEDUPLICATE_STATES': False, 'STRATIFIED_FRACTION': 0.0, 'BATCH_SIZE': 16, 'PREFETCH_BATCHES': 0,
+        'WARMUP_SIZE': 16, 'UPDATE_EVERY': 1, 'UPDATES_PER_TRIGGER': 1,
+        'ASYNC_LEARNER': False, 'ACTOR_SYNC_EVERY': 10, 'MAX_LEARN_RATIO': 1.0,
+        'GAMMA': 0.99, 'N_STEP': 1, 'TAU': 0.15, 'HARD_UPDATE_EVERY': 0,
+        'LR_ACTOR': 0.001, 'LR_CRITIC': 0.001, 'WEIGHT_DECAY': 0.0, 'BF16_AUTOCAST': False,
+        'MU': 0.0, 'THETA': 0.15, 'SIGMA': 0.2, 'USE_SIGMA_DECAY': False, 'SIGMA_MIN': 0.05, 'SIGMA_DECAY': 0.99,
+        'NOISE': 'ou', 'NOISE_BLOCK_SIZE': 1024, 'NOISE_DECAY_STEPS': 100000,
+        'USE_PER': False, 'PER_ALPHA': 0.6, 'PER_BETA': 0.4, 'PER_BETA_INCREMENT': 0.0001, 'PER_EPSILON': 0.00001,
+        'SHARED_MEMORY': False, 'SHARED_SAMPLING': False, 'STACKED_AGENTS': False,
+        'TORCH_THREADS': 0, 'TORCH_INTEROP_THREADS': 0, 'USE_MKLDNN': True, 'LEARNER_CPUS': None, 'UNITY_CPUS': None,
+        'CPU_AUTOTUNE': False,
+    })
+    hyperparameters.update(overrides)
+    return hyperparameters
+
+
+def run_steps(agent, count, state_size=8):
+    rng = np.random.default_rng(0)
+    for _ in range(count):
+        states = rng.standard_normal((1, state_size))
+        actions = agent.act(states).copy()
+        agent.step(states, actions, rng.random(), rng.standard_normal((1, state_size)), False)
+
+
+def test_async_learner_respects_the_step_ratio_and_syncs_the_actor():
+    hyperparameters = make_hyperparameters(ASYNC_LEARNER=True, ACTOR_SYNC_EVERY=5, MAX_LEARN_RATIO=0.5)
+    agent = DDPGAgent(state_size=8, action_size=2, hyperparameters=hyperparameters, num_agents=1, random_seed=0)
+    assert agent.actor_acting is not agent.actor_local
+    run_steps(agent, 60)
+
+    learner = agent.async_learner
+    deadline = time.time() + 30
+    while learner.learn_steps < 0.5 * 60 - 1 and time.time() < deadline:
+        time.sleep(0.01)
+    time.sleep(0.1)
+    assert 20 <= learner.learn_steps <= 30
+    assert learner.syncs == learner.learn_steps // 5
+    agent.close()
+    assert learner.error is None
+    if learner.learn_steps % 5 == 0:
+        torch.testing.assert_close(agent.actor_acting.flat_parameters, agent.actor_local.flat_parameters)
+
+
+def test_learning_runs_updates_per_trigger_every_update_every_steps_after_warmup():
+    hyperparameters = make_hyperparameters(WARMUP_SIZE=20, UPDATE_EVERY=4, UPDATES_PER_TRIGGER=3)
+    agent = DDPGAgent(state_size=8, action_size=2, hyperparameters=hyperparameters, num_agents=1, random_seed=0)
+    learned, learn = [], agent.learn
+
+    def counting_learn(experiences):
+        learned.append(agent.t_step)
+        learn(experiences)
+
+    agent.learn = counting_learn
+    run_steps(agent, 42)
+    # The buffer holds one row per step, so it exceeds the warm-up after step 20:
+    assert learned == [step for step in (24, 28, 32, 36, 40) for _ in range(3)]
+    assert agent.learn_step == 15
+    agent.close()
+
+
+def test_hard_updates_copy_the_targets_every_hard_update_every_learns():
+    # A warm-up as large as the buffer keeps step() from learning on its own:
+    hyperparameters = make_hyperparameters(HARD_UPDATE_EVERY=3, WARMUP_SIZE=1000)
+    agent = DDPGAgent(state_size=8, action_size=2, hyperparameters=hyperparameters, num_agents=1, random_seed=0)
+    run_steps(agent, 40)
+    targets = [agent.actor_target.flat_parameters.clone(), agent.critic_target.flat_parameters.clone()]
+    for learn_step in range(1, 10):
+        agent.learn(agent.memory.sample())
+        pairs = ((agent.actor_local, agent.actor_target), (agent.critic_local, agent.critic_target))
+        for (local, target), previous in zip(pairs, targets):
+            if learn_step % 3 == 0:
+                torch.testing.assert_close(target.flat_parameters, local.flat_parameters, rtol=0, atol=0)
+            else:
+                torch.testing.assert_close(target.flat_parameters, previous, rtol=0, atol=0)
+                assert not torch.equal(target.flat_parameters, local.flat_parameters)
+        targets = [agent.actor_target.flat_parameters.clone(), agent.critic_target.flat_parameters.clone()]
+    agent.close()
+
+
+def test_compiled_actor_matches_eager_actor(tmp_path):
+    agent = DDPGAgent(state_size=8, action_size=2, hyperparameters=make_hyperparameters(), num_agents=2, random_seed=0)
+    states = np.random.default_rng(0).standard_normal((2, 8))
+    eager_actions = agent.act(states, add_noise=False).copy()
+
+    path = str(tmp_path / "actor.pt")
+    agent.compile_for_inference(path=path)
+    np.testing.assert_allclose(agent.act(states, add_noise=False), eager_actions, rtol=1e-6, atol=1e-6)
+    # The saved module loads and runs without the Actor class:
+    loaded = torch.jit.load(path)
+    with torch.no_grad():
+        actions = loaded(torch.from_numpy(states.astype(np.float32))).numpy()
+    np.testing.assert_allclose(actions, eager_actions, rtol=1e-6, atol=1e-6)
+    agent.close()
+
+
+def test_batched_act_matches_per_agent_forward_passes():
+    # A sigma large enough for the noisy actions to be clipped:
+    hyperparameters = make_hyperparameters(NOISE='gaussian', SIGMA=2.0)
+    agent = DDPGAgent(state_size=8, action_size=2, hyperparameters=hyperparameters, num_agents=3, random_seed=0)
+    noise = make_noise((3, 2), hyperparameters, 0)
+    rng = np.random.default_rng(0)
+    for _ in range(4):
+        states = rng.standard_normal((3, 8))
+        agent.actor_local.eval()
+        with torch.no_grad():
+            rows = np.concatenate([agent.actor_local(torch.from_numpy(row[None].astype(np.float32))).numpy()
+                                   for row in states])
+        agent.actor_local.train()
+
+        actions = agent.act(states, add_noise=False)
+        np.testing.assert_allclose(actions, rows, rtol=1e-6, atol=1e-6)
+        noisy_actions = agent.act(states)
+        # Both calls return the agent's reused buffer, clipped in place:
+        assert noisy_actions is actions and noisy_actions is agent.actions
+        np.testing.assert_allclose(noisy_actions, np.clip(rows + noise.sample(), -1, 1), rtol=1e-6, atol=1e-6)
+        assert np.abs(noisy_actions).max() == 1
+    agent.close()
+
+
+def test_bf16_autocast_keeps_fp32_weights():
+    agent = DDPGAgent(state_size=8, action_size=2, hyperparameters=make_hyperparameters(BF16_AUTOCAST=True), num_agents=1, random_seed=0)
+    before = agent.actor_local.flat_parameters.clone()
+    run_steps(agent, 40)
+    for network in (agent.actor_local, agent.critic_local, agent.actor_target):
+        assert all(parameter.dtype == torch.float32 for parameter in network.parameters())
+    assert not torch.equal(agent.actor_local.flat_parameters, before)
+    assert torch.isfinite(agent.critic_local.flat_parameters).all()
+    agent.close()
+
+
+def test_torch_without_autocast_only_fails_when_bf16_is_requested(monkeypatch):
+    monkeypatch.delattr(torch, "autocast")
+    agent = DDPGAgent(state_size=8, action_size=2, hyperparameters=make_hyperparameters(), num_agents=1, random_seed=0)
+    run_steps(agent, 40)
+    agent.close()
+    with pytest.raises(RuntimeError, match="BF16_AUTOCAST"):
+        DDPGAgent(state_size=8, action_size=2, hyperparameters=make_hyperparameters(BF16_AUTOCAST=True), num_agents=1, random_seed=0)
+
+
+def test_quantized_actor_stays_close_to_fp32(tmp_path):
+    agent = DDPGAgent(state_size=8, action_size=2, hyperparameters=make_hyperparameters(), num_agents=1, random_seed=0)
+    # Weights like a trained actor's, with a last layer larger than its initialisation:
+    agent.actor_local.fc3.weight.data.normal_(0, 0.1)
+    states = np.random.default_rng(0).standard_normal((1, 8))
+    fp32_actions = agent.act(states, add_noise=False).copy()
+
+    path = str(tmp_path / "actor_int8.pt")
+    quantized, deviation = agent.quantize_for_inference(path=path)
+    assert deviation < 0.05
+    np.testing.assert_allclose(agent.act(states, add_noise=False), fp32_actions, atol=0.05)
+
+    other = DDPGAgent(state_size=8, action_size=2, hyperparameters=make_hyperparameters(), num_agents=1, random_seed=1)
+    other.load_inference_actor(path)
+    np.testing.assert_allclose(other.act(states, add_noise=False), agent.act(states, add_noise=False), atol=1e-6)
+    agent.close()
+    other.close()
+
+
+def test_shared_sampling_is_rejected_with_a_prefetching_agent():
+    buffer = MultiAgentReplayBuffer(num_agents=2, state_size=8, action_size=2, buffer_size=100, batch_size=16,
+                                    seed=0, same_indices=True)
+    for overrides in ({'PREFETCH_BATCHES': 2}, {'ASYNC_LEARNER': True}):
+        with pytest.raises(ValueError, match="SHARED_SAMPLING"):
+            DDPGAgent(state_size=8, action_size=2, hyperparameters=make_hyperparameters(SHARED_MEMORY=True, SHARED_SAMPLING=True, **overrides),
+                      num_agents=1, random_seed=0, memory=buffer.view(0))
@@ -0,0 +1,19 @@
+import json
+
+import torch
+
+from cpu_profile import autotune
+
+
+def test_autotune_saves_the_fastest_setting(tmp_path):
+    threads = torch.get_num_threads()
+    profile_file = str(tmp_path / "results_0" / "cpu_profile.json")
+    profile = autotune(state_size=8, action_size=2, batch_size=16, profile_file=profile_file, thread_counts=[1, 2], repeats=2)
+
+    with open(profile_file) as handle:
+        saved = json.load(handle)
+    assert saved == profile
+    assert len(saved['timings']) in (2, 4)
+    assert saved['seconds'] == min(timing['seconds'] for timing in saved['timings'])
+    # The process settings are restored afterwards:
+    assert torch.get_num_threads() == threads
@@ -0,0 +1,50 @@
+import struct
+
+import numpy as np
+import pytest
+import torch
+
+from agent import DDPGAgent
+from flat_checkpoint import save_agent, load_agent, save_flat_checkpoint, load_flat_checkpoint, MAGIC
+from .test_agent import make_hyperparameters, run_steps
+
+
+def test_flat_checkpoint_round_trip(tmp_path):
+    file_name = str(tmp_path / "tensors.flat")
+    tensors = {'matrix': torch.randn(3, 5), 'scalar': torch.tensor(7.0), 'vector': np.arange(4, dtype=np.float64)}
+    save_flat_checkpoint(file_name, tensors, {'note': 'test'})
+
+    loaded, metadata = load_flat_checkpoint(file_name)
+    assert metadata == {'note': 'test'}
+    torch.testing.assert_close(loaded['matrix'], tensors['matrix'])
+    assert loaded['scalar'].shape == () and loaded['scalar'].item() == 7.0
+    assert loaded['vector'].dtype == torch.float32
+    # The tensors are views into one mapping of the file, at their aligned offsets:
+    assert (loaded['vector'].data_ptr() - loaded['matrix'].data_ptr()) % 64 == 0
+    assert 0 < loaded['vector'].data_ptr() - loaded['matrix'].data_ptr() < 1024
+
+    with open(file_name, 'r+b') as handle:
+        handle.seek(len(MAGIC))
+        handle.write(struct.pack('<I', 99))
+    with pytest.raises(ValueError):
+        load_flat_checkpoint(file_name)
+
+
+def test_agent_flat_checkpoint_restores_networks_and_optimizers(tmp_path):
+    agent = DDPGAgent(state_size=8, action_size=2, hyperparameters=make_hyperparameters(), num_agents=1, random_seed=0)
+    run_steps(agent, 30)
+    file_name = str(tmp_path / "agent1.flat")
+    save_agent(agent, file_name)
+
+    restored = DDPGAgent(state_size=8, action_size=2, hyperparameters=make_hyperparameters(), num_agents=1, random_seed=1)
+    load_agent(restored, file_name)
+    for network in ('actor_local', 'actor_target', 'critic_local', 'critic_target'):
+        torch.testing.assert_close(getattr(restored, network).flat_parameters, getattr(agent, network).flat_parameters)
+    expected = agent.critic_optimizer.state_dict()
+    state = restored.critic_optimizer.state_dict()
+    assert state['param_groups'] == expected['param_groups']
+    for index, values in expected['state'].items():
+        for key, value in values.items():
+            torch.testing.assert_close(torch.as_tensor(state['state'][index][key]), torch.as_tensor(value))
+    agent.close()
+    restored.close()
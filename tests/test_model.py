@@ -0,0 +1,59 @@
+import torch
+
+from model import Actor, Critic, StackedActor, StackedCritic, flatten_parameters
+
+
+def test_flattened_parameters_are_views_of_one_tensor():
+    local = Critic(state_size=6, action_size=2, seed=0, fcs1_units=16, fc2_units=8)
+    target = Critic(state_size=6, action_size=2, seed=1, fcs1_units=16, fc2_units=8)
+    expected = [0.25 * l.detach() + 0.75 * t.detach() for l, t in zip(local.parameters(), target.parameters())]
+    flat = flatten_parameters(target)
+    local_flat = flatten_parameters(local)
+    assert flat.numel() == sum(p.numel() for p in target.parameters())
+
+    # One fused update reaches every parameter:
+    flat.lerp_(local_flat, 0.25)
+    for parameter, value in zip(target.parameters(), expected):
+        torch.testing.assert_close(parameter.detach(), value)
+
+    # Loading a state dict writes through to the flat tensor:
+    target.load_state_dict(local.state_dict())
+    torch.testing.assert_close(flat, local_flat)
+
+
+def test_flattened_actor_still_trains():
+    actor = Actor(state_size=6, action_size=2, seed=0, fc1_units=16, fc2_units=8)
+    flat = flatten_parameters(actor)
+    before = flat.clone()
+    optimizer = torch.optim.Adam(actor.parameters(), lr=0.01)
+    actor(torch.randn(4, 6)).sum().backward()
+    optimizer.step()
+    assert not torch.equal(flat, before)
+
+
+def test_stacked_networks_match_single_agent_networks():
+    torch.manual_seed(0)
+    stacked_actor = StackedActor(num_agents=4, state_size=6, action_size=2, seed=0, fc1_units=16, fc2_units=8)
+    stacked_critic = StackedCritic(num_agents=4, state_size=6, action_size=2, seed=0, fcs1_units=16, fc2_units=8).eval()
+    # Give every agent different weights:
+    for parameter in stacked_actor.parameters():
+        parameter.data.normal_()
+    states = torch.randn(4, 5, 6)
+    actions = stacked_actor(states)
+    actions.sum().backward()
+    q_values = stacked_critic(states, actions.detach())
+
+    for i in range(4):
+        actor = Actor(state_size=6, action_size=2, seed=0, fc1_units=16, fc2_units=8)
+        actor.load_state_dict(stacked_actor.agent_state_dict(i))
+        critic = Critic(state_size=6, action_size=2, seed=0, fcs1_units=16, fc2_units=8).eval()
+        critic.load_state_dict(stacked_critic.agent_state_dict(i))
+        torch.testing.assert_close(actor(states[i]), actions[i])
+        torch.testing.assert_close(critic(states[i], actions[i].detach()), q_values[i])
+
+        # The summed loss leaves each agent with the gradients of its own loss:
+        actor(states[i]).sum().backward()
+        torch.testing.assert_close(actor.fc1.weight.grad.t(), stacked_actor.fc1.weight.grad[i])
+
+    stacked_actor.load_agent_state_dict(1, stacked_actor.agent_state_dict(0))
+    torch.testing.assert_close(stacked_actor(states[:1].expand(4, 5, 6))[1], actions[0])
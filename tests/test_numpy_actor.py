@@ -0,0 +1,40 @@
+import subprocess
+import sys
+from os import path
+
+import numpy as np
+import torch
+
+from model import Actor, flatten_parameters
+from numpy_actor import NumpyActor, load_state_dict
+
+
+def test_numpy_actor_matches_torch_actor(tmp_path):
+    actor = Actor(state_size=48, action_size=2, seed=0)
+    actor.fc3.weight.data.normal_(0, 0.1)
+    states = np.random.default_rng(0).standard_normal((5, 48))
+    with torch.no_grad():
+        expected = actor(torch.from_numpy(states).float()).numpy()
+
+    # Separate storages, as saved by the Trainer, and views into one flat storage:
+    separate_file = str(tmp_path / "separate_actor.pth")
+    torch.save({key: value.clone() for key, value in actor.state_dict().items()}, separate_file)
+    flatten_parameters(actor)
+    flat_file = str(tmp_path / "flat_actor.pth")
+    torch.save(actor.state_dict(), flat_file)
+
+    for file_name in (separate_file, flat_file):
+        numpy_actor = NumpyActor.from_file(file_name)
+        np.testing.assert_allclose(numpy_actor.act(states), expected, rtol=1e-5, atol=1e-6)
+        np.testing.assert_allclose(numpy_actor.act(states[:1]), expected[:1], rtol=1e-5, atol=1e-6)
+    state_dict = load_state_dict(flat_file)
+    assert list(state_dict) == list(actor.state_dict())
+
+
+def test_numpy_actor_loads_without_torch(tmp_path):
+    file_name = str(tmp_path / "actor.pth")
+    torch.save(Actor(state_size=8, action_size=2, seed=0).state_dict(), file_name)
+    package = path.dirname(path.dirname(path.abspath(__file__)))
+    script = ("import sys; sys.path.insert(0, {!r}); from numpy_actor import NumpyActor; "
+              "NumpyActor.from_file({!r}).act([0.0] * 8); assert 'torch' not in sys.modules").format(package, file_name)
+    subprocess.run([sys.executable, "-c", script], check=True)
@@ -0,0 +1,37 @@
+import numpy as np
+
+from ounoise import OUNoise, make_noise
+from .test_agent import make_hyperparameters
+
+
+def test_ou_blocks_match_the_step_by_step_recursion():
+    hyperparameters = make_hyperparameters(NOISE_BLOCK_SIZE=7, USE_SIGMA_DECAY=True, SIGMA_DECAY=0.9)
+    noise = OUNoise((2, 3), hyperparameters, 0)
+    generators = [np.random.default_rng([0, stream]) for stream in range(2)]
+    state, position = np.zeros((2, 3)), 7
+    # Construction decays sigma once, like the original reset() in __init__:
+    sigma = max(hyperparameters.SIGMA_MIN, hyperparameters.SIGMA * hyperparameters.SIGMA_DECAY)
+    for _ in range(5):
+        noise.reset()
+        state[:], sigma = 0, max(hyperparameters.SIGMA_MIN, sigma * hyperparameters.SIGMA_DECAY)
+        for _ in range(9):
+            if position == 7:
+                block = np.stack([generator.standard_normal((7, 3)) for generator in generators], axis=1)
+                position = 0
+            state += hyperparameters.THETA * (hyperparameters.MU - state) + sigma * block[position]
+            position += 1
+            np.testing.assert_allclose(noise.sample(), state, atol=1e-12)
+
+
+def test_agent_streams_do_not_depend_on_grouping_and_survive_state_dict():
+    hyperparameters = make_hyperparameters(NOISE='gaussian', NOISE_BLOCK_SIZE=4)
+    joint = make_noise((2, 2), hyperparameters, 0)
+    second = make_noise((1, 2), hyperparameters, 0, streams=[1])
+    for _ in range(6):
+        np.testing.assert_array_equal(joint.sample()[1], second.sample()[0])
+
+    state = second.state_dict()
+    expected = [second.sample().copy() for _ in range(6)]
+    restored = make_noise((1, 2), hyperparameters, 0, streams=[1])
+    restored.load_state_dict(state)
+    np.testing.assert_array_equal([restored.sample().copy() for _ in range(6)], expected)
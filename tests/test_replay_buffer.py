@@ -0,0 +1,302 @@
+import os
+
+import numpy as np
+import pytest
+
+from replay_buffer import ReplayBuffer, PrioritizedReplayBuffer, MultiAgentReplayBuffer, BatchPrefetcher, NStepAccumulator, \
+    SumTree, MinTree
+
+
+def fill(buffer, count, state_size=4, action_size=2):
+    for i in range(count):
+        state = np.full(state_size, i, dtype=np.float64)
+        action = np.full(action_size, i / 10)
+        buffer.add(state, action, float(i), state + 1, i % 5 == 4)
+
+
+def test_replay_buffer_sample_shapes():
+    buffer = ReplayBuffer(state_size=4, action_size=2, buffer_size=100, batch_size=8, seed=0)
+    fill(buffer, 20)
+    assert len(buffer) == 20
+    states, actions, rewards, next_states, dones = buffer.sample()[:5]
+    assert states.shape == (8, 4)
+    assert actions.shape == (8, 2)
+    assert rewards.shape == (8, 1)
+    assert next_states.shape == (8, 4)
+    assert dones.shape == (8, 1)
+    assert states.dtype == rewards.dtype == dones.dtype
+
+
+def test_replay_buffer_rows_stay_aligned():
+    buffer = ReplayBuffer(state_size=4, action_size=2, buffer_size=100, batch_size=32, seed=0)
+    fill(buffer, 50)
+    states, actions, rewards, next_states, dones = buffer.sample()[:5]
+    np.testing.assert_allclose(states[:, 0].numpy(), rewards[:, 0].numpy())
+    np.testing.assert_allclose(next_states.numpy(), states.numpy() + 1)
+    np.testing.assert_allclose(dones[:, 0].numpy(), (rewards[:, 0].numpy() % 5 == 4))
+
+
+def test_replay_buffer_overwrites_oldest():
+    buffer = ReplayBuffer(state_size=4, action_size=2, buffer_size=10, batch_size=64, seed=0)
+    fill(buffer, 25)
+    assert len(buffer) == 10
+    rewards = buffer.sample().rewards
+    assert rewards.min() >= 15
+
+
+def test_sum_tree_batched_update_and_prefix_search():
+    tree = SumTree(5)
+    tree.update([0, 1, 2, 3, 4], [1.0, 2.0, 3.0, 4.0, 0.0])
+    assert tree.total() == 10.0
+    indices = tree.find_prefix_sum(np.array([0.5, 1.5, 3.5, 9.9]))
+    np.testing.assert_array_equal(indices, [0, 1, 2, 3])
+    tree.update([1, 3], [0.0, 0.0])
+    assert tree.total() == 4.0
+
+    min_tree = MinTree(5)
+    min_tree.update([0, 1, 2], [3.0, 0.5, 2.0])
+    assert min_tree.total() == 0.5
+
+
+def test_prioritized_replay_buffer_prefers_high_priorities():
+    buffer = PrioritizedReplayBuffer(state_size=4, action_size=2, buffer_size=100, batch_size=256, seed=0)
+    fill(buffer, 50)
+    td_errors = np.zeros(50)
+    td_errors[7] = 100.0
+    buffer.update_priorities(np.arange(50), td_errors)
+    experiences = buffer.sample()
+    assert experiences.weights.shape == (256, 1)
+    assert np.mean(experiences.indices == 7) > 0.5
+    # The most frequently sampled experience gets the smallest correction:
+    assert experiences.weights.max() <= 1.0
+    assert experiences.weights[experiences.indices == 7].max() < 1.0
+    np.testing.assert_allclose(experiences.rewards[:, 0].numpy(), experiences.indices)
+
+
+def test_memory_mapped_replay_buffer(tmp_path):
+    storage_dir = str(tmp_path / "replay")
+    os.makedirs(storage_dir)
+    buffer = ReplayBuffer(state_size=4, action_size=2, buffer_size=100, batch_size=32, seed=0,
+                          storage_dir=storage_dir)
+    fill(buffer, 50)
+    assert os.path.exists(os.path.join(storage_dir, "states.dat"))
+    states, actions, rewards, next_states, dones = buffer.sample()[:5]
+    np.testing.assert_allclose(states[:, 0].numpy(), rewards[:, 0].numpy())
+    np.testing.assert_allclose(next_states.numpy(), states.numpy() + 1)
+    buffer.close()
+    assert not os.path.exists(storage_dir)
+
+
+def test_add_batch_wraps_around_the_ring():
+    buffer = ReplayBuffer(state_size=4, action_size=2, buffer_size=10, batch_size=64, seed=0)
+    fill(buffer, 7)
+    rewards = np.arange(7, 12, dtype=np.float64)
+    states = np.repeat(rewards[:, None], 4, axis=1)
+    buffer.add_batch(states, np.zeros((5, 2)), rewards, states + 1, np.zeros(5, dtype=bool))
+    assert len(buffer) == 10
+    assert buffer.position == 2
+    np.testing.assert_array_equal(buffer.rewards[:, 0], [10, 11, 2, 3, 4, 5, 6, 7, 8, 9])
+    np.testing.assert_array_equal(buffer.states[:, 0], buffer.rewards[:, 0])
+
+
+def test_multi_agent_replay_buffer_views():
+    buffer = MultiAgentReplayBuffer(num_agents=2, state_size=4, action_size=2, buffer_size=100, batch_size=16,
+                                    seed=0, same_indices=True)
+    for i in range(30):
+        state = np.full((1, 4), i, dtype=np.float64)
+        actions = np.array([[i, i], [-i, -i]])
+        buffer.add(state, np.reshape(actions, (1, 4)), [i, -i], state + 1, [False, i == 29])
+    assert len(buffer) == 30
+    assert buffer.states.shape == (100, 4)
+
+    first = buffer.view(0).sample()
+    second = buffer.view(1).sample()
+    np.testing.assert_array_equal(first.states.numpy(), second.states.numpy())
+    np.testing.assert_allclose(first.rewards[:, 0].numpy(), first.states[:, 0].numpy())
+    np.testing.assert_allclose(second.rewards[:, 0].numpy(), -first.states[:, 0].numpy())
+    np.testing.assert_allclose(second.actions.numpy(), -first.actions.numpy())
+    np.testing.assert_allclose(second.dones[:, 0].numpy(), first.states[:, 0].numpy() == 29)
+
+    # Sampling again for an agent starts a new round with fresh indices:
+    assert not np.array_equal(buffer.view(0).sample().states.numpy(), first.states.numpy())
+
+
+def test_batch_prefetcher_serves_batches_and_shuts_down():
+    buffer = ReplayBuffer(state_size=4, action_size=2, buffer_size=100, batch_size=8, seed=0)
+    prefetcher = BatchPrefetcher(buffer, queue_size=2, min_size=8)
+    fill(prefetcher, 20)
+    assert len(prefetcher) == 20
+    for _ in range(5):
+        experiences = prefetcher.sample()
+        np.testing.assert_allclose(experiences.next_states.numpy(), experiences.states.numpy() + 1)
+    assert prefetcher.batches == 5
+    assert 0 <= prefetcher.waits <= 5
+    prefetcher.close()
+    assert not prefetcher.thread.is_alive()
+
+
+def test_batch_prefetcher_raises_the_worker_error():
+    buffer = ReplayBuffer(state_size=4, action_size=2, buffer_size=100, batch_size=8, seed=0)
+    fill(buffer, 20)
+
+    def failing_sample():
+        raise ValueError("broken memory")
+
+    buffer.sample = failing_sample
+    prefetcher = BatchPrefetcher(buffer, queue_size=2)
+    with pytest.raises(RuntimeError, match="prefetcher failed") as error:
+        prefetcher.sample()
+    assert isinstance(error.value.__cause__, ValueError)
+    prefetcher.close()
+
+
+def test_compressed_columns_decompress_sampled_rows():
+    dtypes = {"states": "float16", "actions": "int8", "dones": "bit"}
+    buffer = ReplayBuffer(state_size=4, action_size=2, buffer_size=13, batch_size=64, seed=0, dtypes=dtypes)
+    for i in range(20):
+        state = np.full(4, i + 0.25)
+        buffer.add(state, np.full(2, (i - 10) / 10), float(i), state + 1, i % 3 == 0)
+    experiences = buffer.sample()
+    assert experiences.states.dtype == experiences.actions.dtype == experiences.dones.dtype
+    rewards = experiences.rewards[:, 0].numpy()
+    np.testing.assert_allclose(experiences.states[:, 0].numpy(), rewards + 0.25)
+    np.testing.assert_allclose(experiences.next_states[:, 0].numpy(), rewards + 1.25)
+    np.testing.assert_allclose(experiences.actions[:, 0].numpy(), (rewards - 10) / 10, atol=1 / 254)
+    np.testing.assert_array_equal(experiences.dones[:, 0].numpy(), rewards % 3 == 0)
+
+
+def test_bit_column_in_multi_agent_buffer():
+    buffer = MultiAgentReplayBuffer(num_agents=3, state_size=2, action_size=1, buffer_size=7, batch_size=32,
+                                    seed=0, dtypes={"dones": "bit"})
+    for i in range(10):
+        buffer.add(np.full(2, i), np.zeros(3), [i, i, i], np.full(2, i), [i % 2 == 0, i % 3 == 0, False])
+    for agent_index, expected in enumerate([lambda r: r % 2 == 0, lambda r: r % 3 == 0, lambda r: r < 0]):
+        experiences = buffer.view(agent_index).sample()
+        rewards = experiences.rewards[:, 0].numpy()
+        np.testing.assert_array_equal(experiences.dones[:, 0].numpy(), expected(rewards))
+
+
+def test_n_step_accumulator_emits_and_flushes():
+    accumulator = NStepAccumulator(n_step=3, gamma=0.5)
+    emitted = []
+    for t in range(5):
+        transitions = accumulator.push(np.full((1, 2), t), np.full((1, 1), t), 1.0 + t, np.full((1, 2), t + 1), t == 4)
+        emitted.append(transitions)
+    assert emitted[0] is None and emitted[1] is None
+
+    states, actions, returns, next_states, dones, discounts = emitted[2]
+    np.testing.assert_array_equal(states, [[0, 0]])
+    np.testing.assert_allclose(returns, [1 + 0.5 * 2 + 0.25 * 3])
+    np.testing.assert_array_equal(next_states, [[3, 3]])
+    np.testing.assert_allclose(discounts, [0.125])
+
+    # The terminal step flushes the transitions which started at t = 2, 3 and 4:
+    states, actions, returns, next_states, dones, discounts = emitted[4]
+    np.testing.assert_array_equal(states[:, 0], [2, 3, 4])
+    np.testing.assert_allclose(returns, [3 + 0.5 * 4 + 0.25 * 5, 4 + 0.5 * 5, 5])
+    np.testing.assert_array_equal(next_states[:, 0], [5, 5, 5])
+    np.testing.assert_array_equal(dones, [True, True, True])
+    np.testing.assert_allclose(discounts, [0.125, 0.25, 0.5])
+    assert len(accumulator) == 0
+
+
+def test_n_step_accumulator_matches_direct_returns_across_episodes():
+    rng = np.random.default_rng(0)
+    accumulator = NStepAccumulator(n_step=4, gamma=0.9)
+    rewards = rng.standard_normal((60, 2))
+    dones = np.zeros(60, dtype=bool)
+    dones[[10, 12, 40, 59]] = True
+    emitted = []
+    for t in range(60):
+        transitions = accumulator.push(np.full((1, 3), t), np.zeros((1, 2)), rewards[t], np.full((1, 3), t + 1), [dones[t]] * 2)
+        if transitions is not None:
+            emitted.append(transitions)
+    states = np.concatenate([transitions[0] for transitions in emitted])[:, 0].astype(int)
+    returns = np.concatenate([transitions[2] for transitions in emitted]).reshape(-1, 2)
+    next_states = np.concatenate([transitions[3] for transitions in emitted])[:, 0].astype(int)
+    assert len(states) == 60
+    for t, returned, bootstrap in zip(states, returns, next_states):
+        expected = sum(0.9 ** (k - t) * rewards[k] for k in range(t, bootstrap))
+        np.testing.assert_allclose(returned, expected)
+        assert bootstrap - t == min(4, np.argmax(dones[t:]) + 1)
+
+
+def test_n_step_transitions_in_shared_buffer():
+    accumulator = NStepAccumulator(n_step=2, gamma=0.9)
+    buffer = MultiAgentReplayBuffer(num_agents=2, state_size=3, action_size=1, buffer_size=50, batch_size=16,
+                                    seed=0, store_discounts=True)
+    for t in range(6):
+        transitions = accumulator.push(np.full((1, 3), t), np.zeros((1, 2)), [1.0, 2.0], np.full((1, 3), t + 1),
+                                       [t == 5, t == 5])
+        if transitions is not None:
+            buffer.add_batch(*transitions)
+    assert len(buffer) == 6
+    experiences = buffer.view(1).sample()
+    steps_left = 6 - experiences.states[:, 0].numpy()
+    np.testing.assert_allclose(experiences.discounts[:, 0].numpy(), 0.9 ** np.minimum(steps_left, 2), rtol=1e-6)
+    np.testing.assert_allclose(experiences.rewards[:, 0].numpy(), np.where(steps_left > 1, 2 + 0.9 * 2, 2), rtol=1e-6)
+
+
+def test_deduplicated_states_match_stored_experiences():
+    rng = np.random.default_rng(1)
+    buffer = ReplayBuffer(state_size=3, action_size=1, buffer_size=40, batch_size=64, seed=0, deduplicate_states=True)
+    history = {}
+    states = rng.standard_normal((2, 3))
+    for t in range(500):
+        next_states = rng.standard_normal((2, 3))
+        dones = rng.random(2) < 0.1
+        # Experiences remember their own step in the reward column:
+        buffer.add_batch(states, np.zeros((2, 1)), [2 * t, 2 * t + 1], next_states, dones)
+        history[2 * t] = (states[0], next_states[0])
+        history[2 * t + 1] = (states[1], next_states[1])
+
+        experiences = buffer.sample()
+        steps = experiences.rewards[:, 0].numpy().astype(int)
+        assert steps.min() >= 2 * t + 2 - 40
+        for step, state, next_state in zip(steps, experiences.states.numpy(), experiences.next_states.numpy()):
+            np.testing.assert_allclose(state, history[step][0], rtol=1e-6)
+            np.testing.assert_allclose(next_state, history[step][1], rtol=1e-6)
+
+        # Most rows continue their episode from the next state, others restart from a fresh state:
+        states = np.where(rng.random((2, 1)) < 0.9, next_states, rng.standard_normal((2, 3)))
+    assert len(buffer) > 30
+
+
+def test_stratified_sampling_from_sparse_reward_index():
+    buffer = ReplayBuffer(state_size=4, action_size=2, buffer_size=50, batch_size=20, seed=0, stratified_fraction=0.25)
+    for i in range(120):
+        reward = 0.1 if i % 10 == 0 else 0.0
+        buffer.add(np.full(4, i), np.zeros(2), reward, np.full(4, i + 1), i % 40 == 39)
+
+    # The index only holds the sparse rows which have not been overwritten:
+    index = buffer.sparse_index
+    sparse_rows = sorted(index.rows[:len(index)])
+    expected_steps = [i for i in range(70, 120) if i % 10 == 0 or i % 40 == 39]
+    assert sparse_rows == sorted(i % 50 for i in expected_steps)
+    np.testing.assert_array_equal(index.positions[index.rows[:len(index)]], np.arange(len(index)))
+
+    experiences = buffer.sample()
+    sparse = (experiences.rewards[:, 0] != 0) | (experiences.dones[:, 0] != 0)
+    assert sparse[:5].all()
+    assert experiences.states[:, 0].min() >= 70
+
+
+def test_sample_batches_splits_one_gather():
+    buffer = ReplayBuffer(state_size=4, action_size=2, buffer_size=100, batch_size=8, seed=0, stratified_fraction=0.25)
+    for i in range(100):
+        buffer.add(np.full(4, i), np.zeros(2), 0.1 if i % 20 == 0 else 0.0, np.full(4, i + 1), False)
+    batches = buffer.sample_batches(3)
+    assert len(batches) == 3
+    for states, actions, rewards, next_states, dones in (batch[:5] for batch in batches):
+        assert states.shape == (8, 4) and rewards.shape == (8, 1)
+        np.testing.assert_allclose(next_states.numpy(), states.numpy() + 1)
+        # Every batch holds its own stratified share of rewarded rows:
+        assert (rewards[:2, 0] != 0).all()
+
+    prioritized = PrioritizedReplayBuffer(state_size=4, action_size=2, buffer_size=64, batch_size=8, seed=0)
+    fill(prioritized, 64)
+    batches = prioritized.sample_batches(4)
+    for batch in batches:
+        assert batch.weights.shape == (8, 1) and batch.indices.shape == (8,)
+        # The priority segments are dealt out in turn, so every batch spans the whole buffer:
+        assert batch.indices.min() < 16 and batch.indices.max() >= 48
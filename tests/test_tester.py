@@ -0,0 +1,39 @@
+import numpy as np
+
+import tester
+import trainer
+from .test_agent import make_hyperparameters
+from .test_trainer import DeterministicEnvironment
+
+
+def test_tester_plays_agents_trained_with_background_threads(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(trainer, "Environment", DeterministicEnvironment)
+    monkeypatch.setattr(tester, "Environment", DeterministicEnvironment)
+    hyperparameters = make_hyperparameters(ITERATION=7, EPISODES=2, ASYNC_LEARNER=True, PREFETCH_BATCHES=2, REPLAY_MEMMAP=True)
+    trainer.Trainer("unused", hyperparameters, random_seed=0).train()
+    saved_files = sorted(p.name for p in (tmp_path / "results" / "results_7").iterdir())
+
+    for quantized in (False, True):
+        play_tester = tester.Tester("unused", hyperparameters, random_seed=0, games_to_play=1, quantized=quantized)
+        assert all(agent.async_learner is None and agent.replay_buffer().storage_dir is None for agent in play_tester.agents)
+        play_tester.load_weights()
+        play_tester.play()
+        assert np.all(np.abs(play_tester.actions) <= 1)
+    # Playing leaves the results folder as training left it:
+    assert sorted(p.name for p in (tmp_path / "results" / "results_7").iterdir()) == saved_files
+
+
+def test_tester_exports_compiled_actors_only_when_asked(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(trainer, "Environment", DeterministicEnvironment)
+    monkeypatch.setattr(tester, "Environment", DeterministicEnvironment)
+    hyperparameters = make_hyperparameters(ITERATION=7, EPISODES=2)
+    trainer.Trainer("unused", hyperparameters, random_seed=0).train()
+
+    for quantized, exported in ((False, "agent{}_actor.pt"), (True, "agent{}_actor_int8.pt")):
+        export_tester = tester.Tester("unused", hyperparameters, random_seed=0, quantized=quantized, export_compiled=True)
+        export_tester.load_weights()
+        for i in (1, 2):
+            assert (tmp_path / "results" / "results_7" / exported.format(i)).exists()
+    assert not list((tmp_path / "results" / "results_7").glob("*.tmp"))
@@ -0,0 +1,120 @@
+import time
+
+import numpy as np
+import pytest
+import torch
+
+import trainer
+from .test_agent import make_hyperparameters
+
+
+class DeterministicEnvironment:
+    """Stand-in for the Unity environment whose observations only depend on the step within
+    the episode and the actions, so that a resumed run sees the same episodes."""
+    num_agents = 2
+
+    def __init__(self, file_name=None, seed=0, train_mode=True, no_graphics=True):
+        self.reset()
+
+    def get_num_of_agents(self):
+        return self.num_agents
+
+    def get_states_per_agent(self):
+        return 4 * self.num_agents
+
+    def get_action_size(self):
+        return 2
+
+    def reset(self):
+        self.t = 0
+        self.states = np.zeros((self.num_agents, 4))
+
+    def step(self, actions):
+        self.t += 1
+        assert np.shape(actions) == (1, 2 * self.num_agents)
+        self.states = np.sin(np.arange(4 * self.num_agents).reshape(self.num_agents, 4) * self.t + np.sum(actions))
+        self.env_info = type("EnvInfo", (), {})()
+        self.env_info.rewards = [0.1 if self.t % (3 + i) == 0 else 0.0 for i in range(self.num_agents)]
+        self.env_info.local_done = [self.t >= 12] * self.num_agents
+
+    def close(self):
+        pass
+
+
+def test_resumed_training_matches_uninterrupted_training(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(trainer, "Environment", DeterministicEnvironment)
+
+    def run(episodes, resume_from=None, **overrides):
+        hyperparameters = make_hyperparameters(EPISODES=episodes, SAVE_CHECKPOINT=True, STRATIFIED_FRACTION=0.25, **overrides)
+        torch.manual_seed(0)
+        np.random.seed(0)
+        run_trainer = trainer.Trainer("unused", hyperparameters, random_seed=0)
+        if resume_from is not None:
+            run_trainer.resume(resume_from)
+        run_trainer.train()
+        return run_trainer
+
+    for overrides in ({}, {'SHARED_MEMORY': True, 'N_STEP': 3, 'ITERATION': 1}):
+        uninterrupted = run(4, **overrides)
+        checkpoint = str(tmp_path / "results" / "results_{}".format(overrides.get('ITERATION', 0)) / "checkpoint")
+        run(2, **overrides)
+        resumed = run(4, resume_from=checkpoint, **overrides)
+
+        assert resumed.current_episode == 4
+        assert resumed.scores == uninterrupted.scores
+        for agent, expected in zip(resumed.training_agents(), uninterrupted.training_agents()):
+            torch.testing.assert_close(agent.actor_local.flat_parameters, expected.actor_local.flat_parameters, rtol=0, atol=0)
+            torch.testing.assert_close(agent.critic_target.flat_parameters, expected.critic_target.flat_parameters, rtol=0, atol=0)
+
+
+def test_trainer_runs_any_number_of_agents(tmp_path, monkeypatch):
+    monkeypatch.chdir(tmp_path)
+    monkeypatch.setattr(DeterministicEnvironment, "num_agents", 4)
+    monkeypatch.setattr(trainer, "Environment", DeterministicEnvironment)
+
+    for overrides in ({'SHARED_MEMORY': True}, {'SHARED_MEMORY': True, 'STACKED_AGENTS': True, 'ITERATION': 1}):
+        run_trainer = trainer.Trainer("unused", make_hyperparameters(EPISODES=3, **overrides), random_seed=0)
+        # The agents learn from views of the shared buffer, which is still empty here:
+        assert all(agent.memory.buffer is run_trainer.memory for agent in run_trainer.agents)
+        run_trainer.train()
+        assert len(run_trainer.model_state_dicts()) == 4
+        results_folder = tmp_path / "results" / "results_{}".format(overrides.get('ITERATION', 0))
+        assert sorted(p.name for p in results_folder.glob("agent*_actor.pth")) == ["agent{}_actor.pth".format(i) for i in range(1, 5)]
+
+
+def test_checkpoint_writer_coalesces_saves_and_keeps_solved_files(tmp_path):
+    def save(value):
+        return lambda file_name: torch.save(value, file_name)
+
+    latest, solved = str(tmp_path / "agent1_actor.pth"), str(tmp_path / "solved_agent1_actor.pth")
+    writer = trainer.CheckpointWriter(min_interval=60.0)
+    writer.submit({latest: save(1)})
+    deadline = time.time() + 10
+    while writer.writes < 1 and time.time() < deadline:
+        time.sleep(0.01)
+    # Within the interval the saves wait, and only the newest snapshot of each file is kept:
+    writer.submit({latest: save(2), solved: save(2)})
+    writer.submit({latest: save(3)})
+    assert torch.load(latest) == 1
+    writer.close()
+
+    assert (writer.saves, writer.writes) == (3, 2)
+    assert torch.load(latest) == 3 and torch.load(solved) == 2
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["agent1_actor.pth", "solved_agent1_actor.pth"]
+
+
+def test_deduplicated_states_are_rejected_with_n_step_returns(monkeypatch):
+    monkeypatch.setattr(trainer, "Environment", DeterministicEnvironment)
+    for shared_memory in (True, False):
+        hyperparameters = make_hyperparameters(SHARED_MEMORY=shared_memory, DEDUPLICATE_STATES=True, N_STEP=3)
+        with pytest.raises(ValueError, match="DEDUPLICATE_STATES"):
+            trainer.Trainer("unused", hyperparameters, random_seed=0)
+
+
+def test_stacked_agents_reject_per_prefetching_and_async_learning(monkeypatch):
+    monkeypatch.setattr(trainer, "Environment", DeterministicEnvironment)
+    for overrides in ({'USE_PER': True}, {'PREFETCH_BATCHES': 2}, {'ASYNC_LEARNER': True}):
+        hyperparameters = make_hyperparameters(SHARED_MEMORY=True, STACKED_AGENTS=True, **overrides)
+        with pytest.raises(ValueError, match="STACKED_AGENTS"):
+            trainer.Trainer("unused", hyperparameters, random_seed=0)
@@ -1,12 +1,19 @@
 import numpy as np
 import torch
 import pickle
+import random
+import shutil
+import threading
 from collections import deque
+from functools import partial
 from pathlib import Path
-from os import makedirs, path
-from time import time
-from agent import DDPGAgent
+from os import makedirs, path, replace
+from time import monotonic, time
+from agent import DDPGAgent, MultiAgentDDPG
 from environment import Environment
+from cpu_profile import apply_cpu_profile
+from flat_checkpoint import agent_tensors, save_flat_checkpoint
+from replay_buffer import MultiAgentReplayBuffer, NStepAccumulator, create_storage_dir
 
 class Trainer():
     """
@@ -20,38 +27,77 @@ class Trainer():
         process_scores(): updates scores, prints them
         save_models(): saves the models' weights
         save_scores(): saves the scores in a pickle
+        save_checkpoint(): saves the full training state, to continue training with resume()
+        resume(): restores the full training state from a checkpoint
         display_final_result(): displays final results
     """
     def __init__(self, environment_file_name, hyperparameters, random_seed=0):
         self.env = Environment(file_name=environment_file_name, seed=random_seed, train_mode=True, no_graphics=True)
+        apply_cpu_profile(hyperparameters, self.env)
         self.hyperparameters = hyperparameters
-        
-        #TODO: Finish converting agents into a dynamic list, so that it works in the Soccer environment:
+        self.num_agents = self.env.get_num_of_agents()
+
+        # All agents observe the same joint state, so they can share a single replay buffer
+        # which stores the joint state once. Priorities are per agent, so PER needs separate buffers.
+        self.memory = None
+        self.n_step_accumulator = None
+        if hyperparameters.SHARED_MEMORY and not hyperparameters.USE_PER:
+            if hyperparameters.DEDUPLICATE_STATES and hyperparameters.N_STEP > 1:
+                raise ValueError("DEDUPLICATE_STATES needs N_STEP = 1: an n-step row's state is not the previous row's next state, "
+                                 "so every row would take two state slots and the buffer would hold far fewer experiences")
+            storage_dir = create_storage_dir(hyperparameters.ITERATION) if hyperparameters.REPLAY_MEMMAP else None
+            self.memory = MultiAgentReplayBuffer(num_agents=self.env.get_num_of_agents(),
+                                                 state_size=self.env.get_states_per_agent(),
+                                                 action_size=self.env.get_action_size(),
+                                                 buffer_size=hyperparameters.BUFFER_SIZE,
+                                                 batch_size=hyperparameters.BATCH_SIZE,
+                                                 seed=random_seed,
+                                                 storage_dir=storage_dir,
+                                                 dtypes=hyperparameters.REPLAY_DTYPES,
+                                                 store_discounts=hyperparameters.N_STEP > 1,
+                                                 deduplicate_states=hyperparameters.DEDUPLICATE_STATES,
+                                                 stratified_fraction=hyperparameters.STRATIFIED_FRACTION,
+                                                 same_indices=hyperparameters.SHARED_SAMPLING)
+            if hyperparameters.N_STEP > 1:
+                self.n_step_accumulator = NStepAccumulator(hyperparameters.N_STEP, hyperparameters.GAMMA)
+
+        # Either all agents act and learn together with stacked networks, or each agent is a
+        # DDPGAgent learning from its view of the shared replay buffer or from a private buffer:
+        self.learner = None
         self.agents = []
-        for i in range(self.env.get_num_of_agents()):
-            self.agents.append(DDPGAgent(state_size=self.env.get_states_per_agent(),
-                                action_size=self.env.get_action_size(),
-                                hyperparameters=hyperparameters,
-                                num_agents=1,
-                                random_seed=random_seed
-                                ))
-        
-        # Create the agents which will play against each other:
-        self.agent1 = DDPGAgent(state_size=self.env.get_states_per_agent(),
-                                action_size=self.env.get_action_size(),
-                                hyperparameters=hyperparameters,
-                                num_agents=1,
-                                random_seed=random_seed)
-        self.agent2 = DDPGAgent(state_size=self.env.get_states_per_agent(),
-                                action_size=self.env.get_action_size(),
-                                hyperparameters=hyperparameters,
-                                num_agents=1,
-                                random_seed=random_seed)
-        
+        if hyperparameters.STACKED_AGENTS:
+            if hyperparameters.USE_PER:
+                raise ValueError("STACKED_AGENTS cannot be used with USE_PER")
+            if self.memory is None:
+                raise ValueError("STACKED_AGENTS needs the shared replay buffer: set SHARED_MEMORY")
+            # The stacked learner samples and learns on the training loop:
+            if hyperparameters.ASYNC_LEARNER or hyperparameters.PREFETCH_BATCHES > 0:
+                raise ValueError("STACKED_AGENTS cannot be used with PREFETCH_BATCHES or ASYNC_LEARNER")
+            self.learner = MultiAgentDDPG(state_size=self.env.get_states_per_agent(),
+                                          action_size=self.env.get_action_size(),
+                                          hyperparameters=hyperparameters,
+                                          num_agents=self.env.get_num_of_agents(),
+                                          random_seed=random_seed,
+                                          memory=self.memory)
+        else:
+            for i in range(self.num_agents):
+                self.agents.append(DDPGAgent(state_size=self.env.get_states_per_agent(),
+                                             action_size=self.env.get_action_size(),
+                                             hyperparameters=hyperparameters,
+                                             num_agents=1,
+                                             random_seed=random_seed,
+                                             memory=self.memory.view(i) if self.memory is not None else None,
+                                             agent_index=i))
+        # Every agent's actions of a step, one row per agent:
+        self.actions = np.zeros((self.num_agents, self.env.get_action_size()))
+
         # Create various attributes to keep track of scores and other information
         self.episodes = hyperparameters.EPISODES
         self.save_every = hyperparameters.SAVE_EVERY
+        self.save_checkpoints = hyperparameters.SAVE_CHECKPOINT
+        self.save_flat_checkpoints = hyperparameters.SAVE_FLAT_CHECKPOINTS
         self.iteration = hyperparameters.ITERATION
+        self.checkpoint_writer = CheckpointWriter(hyperparameters.SAVE_MIN_INTERVAL) if hyperparameters.ASYNC_SAVE else None
         self.current_episode = 0
         self.scores_window = deque(maxlen=100)
         self.scores = []
@@ -68,15 +114,15 @@ class Trainer():
         At the end of each episode process_scores() is called to update
         the scores attributes and save the models.
         """
-        for episode in range(1, self.episodes+1):
+        for episode in range(self.current_episode+1, self.episodes+1):
 
             # Reset environment, agents, and scores
             self.env.reset()
-            for agent in self.agents:
-                agent.reset()
-            self.agent1.reset()  # reset the noise
-            self.agent2.reset()  # reset the noise
-            episode_scores = np.zeros(self.env.get_num_of_agents())
+            for agent in self.training_agents():
+                agent.reset()  # reset the noise
+            if self.n_step_accumulator is not None:
+                self.n_step_accumulator.reset()
+            episode_scores = np.zeros(self.num_agents)
 
             # Get initial state of the unity environment and reshape it
             states = np.reshape(self.env.states, (1, self.env.get_states_per_agent()))
@@ -90,15 +136,15 @@ class Trainer():
             # 4) the agents are updated
             # 5) scores are updated
             while True:
-                # Get the first agent actions based on current state, using noise for exploration:
-                #TODO: Finish converting agents into a dynamic list, so that it works in the Soccer environment:
-                actions1 = self.agent1.act(states, add_noise=True)
-                actions2 = self.agent2.act(states, add_noise=True)
-
-                # Concatenate actions and reshape the data. Then send these actions to the environment:
-                #TODO: Finish converting agents into a dynamic list, so that it works in the Soccer environment:
-                actions = np.concatenate((actions1, actions2), axis=0) 
-                actions = np.reshape(actions, (1, 4))
+                # Get every agent's actions based on current state, using noise for exploration:
+                if self.learner is not None:
+                    self.actions[:] = self.learner.act(states, add_noise=True)
+                else:
+                    for i, agent in enumerate(self.agents):
+                        self.actions[i] = agent.act(states, add_noise=True)[0]
+
+                # Send the actions of all agents to the environment as one row:
+                actions = np.reshape(self.actions, (1, -1))
                 self.env.step(actions)
 
                 # Get a response from the environment:
@@ -107,10 +153,21 @@ class Trainer():
                 rewards = self.env.env_info.rewards                      
                 dones = self.env.env_info.local_done                     
 
-                # Save the (S, A, R, S') info to the training agent for replay buffer (memory) and network updates
-                #TODO: Finish converting agents into a dynamic list, so that it works in the Soccer environment:
-                self.agent1.step(states, actions1, rewards[0], next_states, dones[0])
-                self.agent2.step(states, actions2, rewards[1], next_states, dones[1])
+                # Save the (S, A, R, S') info to the training agent for replay buffer (memory) and network updates.
+                # A shared replay buffer receives the joint transition once for all agents,
+                # otherwise each agent stores its own actions, reward and done in its private buffer:
+                if self.memory is not None:
+                    transitions = (states, actions, rewards, next_states, dones)
+                    if self.n_step_accumulator is not None:
+                        transitions = self.n_step_accumulator.push(*transitions)
+                    if transitions is not None:
+                        with self.memory.lock:
+                            self.memory.add_batch(*transitions)
+                if self.learner is not None:
+                    self.learner.step()
+                else:
+                    for i, agent in enumerate(self.agents):
+                        agent.step(states, self.actions[i:i + 1], rewards[i], next_states, dones[i])
 
                 # Set new states to current states so that the next actions can be determined:
                 states = next_states
@@ -126,8 +183,15 @@ class Trainer():
             self.current_episode+= 1
             self.process_scores(episode_scores)
 
-        # Close environment after training is done
+        # Close environment and release the agents' resources after training is done.
+        # Closing the checkpoint writer writes the saves it still holds:
         self.env.close()
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.close()
+        for agent in self.training_agents():
+            agent.close()
+        if self.memory is not None:
+            self.memory.close()
             
     def process_scores(self, episode_scores):
         """
@@ -172,12 +236,17 @@ class Trainer():
             print('\r## CONGRATS! ## Environment solved after {} episodes. Average Score Last 100 Episodes: {:.2f}'.format(
                 self.current_episode, average_score))
             self.save_models(solved=True)
+
+        # Save the full training state during checkpoints, once the episode has been fully processed:
+        if self.save_checkpoints and self.current_episode % self.save_every == 0:
+            self.save_checkpoint()
     
     def save_models(self, solved=False):
         """
         1. Create a folder if it doesn't exist where to store results.
         2. Save Actor and Critic model weights.
         3. Save Actor and Critic model weights for a solved environment (only once)
+        The weights are copied here and written by the checkpoint writer, on its thread with ASYNC_SAVE.
         """
         # Define the results save location for the current iteration
         results_folder = path.join("results", "results_{}".format(self.iteration))
@@ -188,17 +257,11 @@ class Trainer():
         except FileExistsError:
             pass
         
-        # Define the save location for the model weights:
-        agent1_actor = path.join(results_folder, 'agent1_actor.pth'.format())
-        agent1_critic = path.join(results_folder, 'agent1_critic.pth'.format())
-        agent2_actor = path.join(results_folder, 'agent2_actor.pth'.format())
-        agent2_critic = path.join(results_folder, 'agent2_critic.pth'.format())
-        
-        # Save the latest model weights:
-        torch.save(self.agent1.actor_local.state_dict(), agent1_actor)
-        torch.save(self.agent1.critic_local.state_dict(), agent1_critic)
-        torch.save(self.agent2.actor_local.state_dict(), agent2_actor)
-        torch.save(self.agent2.critic_local.state_dict(), agent2_critic)
+        # Snapshot the latest model weights of each agent, i.e. agent1_actor.pth, agent1_critic.pth, agent2_actor.pth, ...:
+        state_dicts = self.model_state_dicts()
+        files = self.model_weight_files(results_folder, state_dicts)
+        if self.save_flat_checkpoints:
+            files.update(self.flat_agent_files(results_folder))
 
         # Save the model weights for the checkpoint when the environment was solved:
         if solved:
@@ -206,15 +269,158 @@ class Trainer():
             self.solved_after = self.current_episode
             self.solved_result = self.best_score
             
-            agent1_actor = path.join(results_folder, 'solved_agent1_actor.pth'.format())
-            agent1_critic = path.join(results_folder, 'solved_agent1_critic.pth'.format())
-            agent2_actor = path.join(results_folder, 'solved_agent2_actor.pth'.format())
-            agent2_critic = path.join(results_folder, 'solved_agent2_critic.pth'.format())
-            torch.save(self.agent1.actor_local.state_dict(), agent1_actor)
-            torch.save(self.agent1.critic_local.state_dict(), agent1_critic)
-            torch.save(self.agent2.actor_local.state_dict(), agent2_actor)
-            torch.save(self.agent2.critic_local.state_dict(), agent2_critic)
+            files.update(self.model_weight_files(results_folder, state_dicts, prefix='solved_'))
+            if self.save_flat_checkpoints:
+                files.update(self.flat_agent_files(results_folder, prefix='solved_'))
+
+        if self.checkpoint_writer is not None:
+            self.checkpoint_writer.submit(files)
+        else:
+            write_files(files)
+
+    def model_weight_files(self, results_folder, state_dicts, prefix=''):
+        """
+        Return the writers of each agent's (actor, critic) state dicts, by file name:
+        {prefix}agent{i}_actor.pth and {prefix}agent{i}_critic.pth.
+        """
+        files = {}
+        for i, (actor_weights, critic_weights) in enumerate(state_dicts, start=1):
+            files[path.join(results_folder, '{}agent{}_actor.pth'.format(prefix, i))] = partial(torch.save, actor_weights)
+            files[path.join(results_folder, '{}agent{}_critic.pth'.format(prefix, i))] = partial(torch.save, critic_weights)
+        return files
+
+    def flat_agent_files(self, results_folder, prefix=''):
+        """
+        Return the writers of each agent's networks, target networks and optimizer states as a flat
+        checkpoint by file name, i.e. agent1.flat, agent2.flat, ..., or agents.flat for the stacked agents.
+        """
+        if self.learner is not None:
+            agents = {'{}agents.flat'.format(prefix): self.learner}
+        else:
+            agents = {'{}agent{}.flat'.format(prefix, i): agent for i, agent in enumerate(self.agents, start=1)}
+        files = {}
+        for file_name, agent in agents.items():
+            with agent.learn_lock:
+                tensors, metadata = agent_tensors(agent)
+            files[path.join(results_folder, file_name)] = partial(save_flat_checkpoint, tensors=tensors, metadata=metadata)
+        return files
+
+    def model_state_dicts(self):
+        """
+        Return the (actor, critic) state dicts of each agent, in the single-agent network format.
+        """
+        if self.learner is not None:
+            return [(self.learner.actor_local.agent_state_dict(i), self.learner.critic_local.agent_state_dict(i))
+                    for i in range(self.learner.num_agents)]
+        state_dicts = []
+        for agent in self.agents:
+            # Copy the weights between learning updates, as they may be learning on a background thread:
+            with agent.learn_lock:
+                state_dicts.append(({key: value.clone() for key, value in agent.actor_local.state_dict().items()},
+                                    {key: value.clone() for key, value in agent.critic_local.state_dict().items()}))
+        return state_dicts
                 
+    def training_agents(self):
+        """
+        Return the agents which act and learn during training.
+        """
+        return [self.learner] if self.learner is not None else self.agents
+
+    def replay_buffers(self):
+        """
+        Return the replay buffers used in training by name: the shared buffer and/or each agent's private buffer.
+        """
+        buffers = {}
+        if self.memory is not None:
+            buffers['shared'] = self.memory
+        for i, agent in enumerate(self.training_agents()):
+            if agent.replay_buffer() is not None:
+                buffers['agent{}'.format(i + 1)] = agent.replay_buffer()
+        return buffers
+
+    def save_checkpoint(self, checkpoint_folder=None):
+        """
+        Save everything needed to continue training exactly where it stopped: the trainer's
+        scores and episode count, every agent's networks, optimizers and noise, the replay
+        buffers (their columns as raw arrays) and the random number generator states.
+        The checkpoint is written to a temporary folder which then replaces the previous
+        checkpoint, so a crash while saving never leaves a partial checkpoint behind.
+        """
+        if checkpoint_folder is None:
+            checkpoint_folder = path.join("results", "results_{}".format(self.iteration), "checkpoint")
+        temporary_folder = checkpoint_folder + ".tmp"
+        previous_folder = checkpoint_folder + ".old"
+        shutil.rmtree(temporary_folder, ignore_errors=True)
+        makedirs(temporary_folder)
+
+        state = {
+            'trainer': {
+                'current_episode': self.current_episode,
+                'scores_window': list(self.scores_window),
+                'scores': self.scores,
+                'average_scores': self.average_scores,
+                'best_score': self.best_score,
+                'solved': self.solved,
+                'solved_after': self.solved_after,
+                'solved_result': self.solved_result,
+                'n_step_window': self.n_step_accumulator.state_dict() if self.n_step_accumulator is not None else None,
+            },
+            'agents': [agent.state_dict() for agent in self.training_agents()],
+            'random_states': {
+                'random': random.getstate(),
+                'numpy': np.random.get_state(),
+                'torch': torch.get_rng_state(),
+            },
+        }
+        with open(path.join(temporary_folder, 'state.pickle'), 'wb') as handle:
+            pickle.dump(state, handle, protocol=pickle.HIGHEST_PROTOCOL)
+        for name, buffer in self.replay_buffers().items():
+            with buffer.lock:
+                buffer.save(path.join(temporary_folder, 'replay_{}'.format(name)))
+
+        # Swap the complete checkpoint in. resume() falls back to the previous one if it is interrupted:
+        if path.exists(checkpoint_folder):
+            shutil.rmtree(previous_folder, ignore_errors=True)
+            replace(checkpoint_folder, previous_folder)
+        replace(temporary_folder, checkpoint_folder)
+        shutil.rmtree(previous_folder, ignore_errors=True)
+
+    def resume(self, checkpoint_folder):
+        """
+        Restore the training state saved by save_checkpoint(), so that train() continues
+        from the episode after the checkpoint. The Trainer must have been created with the
+        same hyperparameters as the one which saved it.
+        The resumed run only matches an uninterrupted run bit for bit without PREFETCH_BATCHES
+        and ASYNC_LEARNER: the batches queued by the sampling workers are not saved, and the
+        workers' random draws depend on thread timing.
+        """
+        if not path.exists(checkpoint_folder) and path.exists(checkpoint_folder + ".old"):
+            checkpoint_folder = checkpoint_folder + ".old"
+        with open(path.join(checkpoint_folder, 'state.pickle'), 'rb') as handle:
+            state = pickle.load(handle)
+
+        trainer_state = state['trainer']
+        self.current_episode = trainer_state['current_episode']
+        self.scores_window = deque(trainer_state['scores_window'], maxlen=100)
+        self.scores = trainer_state['scores']
+        self.average_scores = trainer_state['average_scores']
+        self.best_score = trainer_state['best_score']
+        self.solved = trainer_state['solved']
+        self.solved_after = trainer_state['solved_after']
+        self.solved_result = trainer_state['solved_result']
+        if self.n_step_accumulator is not None:
+            self.n_step_accumulator.load_state_dict(trainer_state['n_step_window'])
+
+        for agent, agent_state in zip(self.training_agents(), state['agents']):
+            agent.load_state_dict(agent_state)
+        for name, buffer in self.replay_buffers().items():
+            with buffer.lock:
+                buffer.load(path.join(checkpoint_folder, 'replay_{}'.format(name)))
+
+        random.setstate(state['random_states']['random'])
+        np.random.set_state(state['random_states']['numpy'])
+        torch.set_rng_state(state['random_states']['torch'])
+
     def save_scores(self):
         """
         Store scores in a pickle
@@ -242,8 +448,106 @@ class Trainer():
         print("\nThe algorithm looped through {} episodes and achieved the best score of {}.".format(
             self.current_episode, self.best_score
         ))
+        if self.hyperparameters.PREFETCH_BATCHES > 0 and self.learner is None:
+            for i, agent in enumerate(self.agents, start=1):
+                print("\nThe agent{} learner waited for a prefetched batch {} times out of {} batches.".format(
+                    i, agent.memory.waits, agent.memory.batches
+                ))
+        if self.hyperparameters.ASYNC_LEARNER and self.learner is None:
+            for i, agent in enumerate(self.agents, start=1):
+                learner = agent.async_learner
+                step_rate, learn_rate = learner.rates()
+                print("\nThe agent{} learner ran {} updates for {} environment steps ({:.1f} updates/s, {:.1f} steps/s) and synced the actor {} times.".format(
+                    i, learner.learn_steps, learner.env_steps, learn_rate, step_rate, learner.syncs
+                ))
+        if self.checkpoint_writer is not None:
+            print("\nThe checkpoint writer wrote the models {} times for {} saves.".format(
+                self.checkpoint_writer.writes, self.checkpoint_writer.saves
+            ))
         if self.solved:
             print("\nCongrats! The agent solved the environment in {} episodes with a score of {}.".format(
                 self.solved_after, self.solved_result
             ))
-            print('')
\ No newline at end of file
+            print('')
+
+def write_files(files):
+    """
+    Write files given as {file name: function writing to a file name} atomically: each one is
+    written to a temporary file next to it, which then replaces it.
+    """
+    for file_name, write in files.items():
+        temporary_file = file_name + '.tmp'
+        write(temporary_file)
+        replace(temporary_file, file_name)
+
+
+class CheckpointWriter():
+    """Writes the snapshots of save_models() on a background thread.
+
+    Saves which arrive while a write is in progress, or sooner than min_interval seconds
+    after the previous write, are merged into one pending write by file name. So only the
+    newest snapshot of a file is written, while files saved once, like the solved models,
+    are kept until they are written. close() writes whatever is still pending.
+    """
+
+    def __init__(self, min_interval=0.0):
+        """Initialize a CheckpointWriter object and start its thread.
+        Params
+        ======
+            min_interval (float): minimum number of seconds between the starts of two writes
+        """
+        self.min_interval = min_interval
+        self.pending = {}       # File name -> function writing its snapshot
+        self.saves = 0          # Saves submitted
+        self.writes = 0         # Writes of the pending files
+        self.last_write = None
+        self.closed = False
+        self.error = None
+        self.condition = threading.Condition()
+        self.thread = threading.Thread(target=self.run, name="CheckpointWriter", daemon=True)
+        self.thread.start()
+
+    def submit(self, files):
+        """Queue files for writing, given as {file name: function writing to a file name}.
+        Once the writer is closed the files are written right away."""
+        if self.error is not None:
+            raise RuntimeError("the checkpoint writer failed") from self.error
+        with self.condition:
+            self.saves += 1
+            if not self.closed:
+                self.pending.update(files)
+                self.condition.notify()
+                return
+        write_files(files)
+        self.writes += 1
+
+    def run(self):
+        """Write the pending files until closed, at most once every min_interval seconds."""
+        try:
+            while True:
+                with self.condition:
+                    while not self.pending and not self.closed:
+                        self.condition.wait()
+                    if not self.pending:
+                        return
+                    if self.last_write is not None and not self.closed:
+                        # Keep coalescing saves until the interval has passed, or the writer is closed:
+                        wait = self.last_write + self.min_interval - monotonic()
+                        if wait > 0:
+                            self.condition.wait(wait)
+                            continue
+                    files, self.pending = self.pending, {}
+                    self.last_write = monotonic()
+                write_files(files)
+                self.writes += 1
+        except Exception as error:
+            self.error = error
+
+    def close(self):
+        """Write the pending files without waiting for the interval, and stop the thread."""
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        self.thread.join()
+        if self.error is not None:
+            raise RuntimeError("the checkpoint writer failed") from self.error